@@ -0,0 +1,87 @@
+from bisect import bisect_left
+from heapq import nlargest
+from threading import Lock
+from time import time
+import os, tempfile
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class PrefixIndex(object):
+    # Lines of a text file, sorted by their lowercase form so a prefix
+    # lookup is a binary search. The file is stat()ed at most every
+    # check_interval seconds and reloaded when its mtime changes.
+
+    def __init__(self, path, limit=20, check_interval=5):
+        self.path = path
+        self.limit = limit
+        self.check_interval = check_interval
+        self.keys = []
+        self.values = []
+        self.mtime = None
+        self.checked = None
+        self.lock = Lock()
+
+    def load(self):
+        with open(self.path) as f:
+            entries = sorted((line.lower(), line) for line in
+                    (line.rstrip('\r\n') for line in f) if line)
+        return ([k for k, v in entries], [v for k, v in entries])
+
+    def check(self):
+        now = time()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if self.checked is not None and \
+                    now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            (self.keys, self.values) = self.load()
+            self.mtime = mtime
+
+    def complete(self, term, rank=None):
+        # Up to limit entries starting with term, in file order, or the
+        # ones with the highest rank[entry] if rank is given.
+        self.check()
+        keys, values = self.keys, self.values
+        term = term.lower()
+        start = bisect_left(keys, term)
+        if rank is None:
+            found = []
+            for i in xrange(start, min(start + self.limit, len(keys))):
+                if not keys[i].startswith(term):
+                    break
+                found.append(values[i])
+            return found
+        end = bisect_left(keys, term + '\xff', start)
+        return nlargest(self.limit, values[start:end],
+                key=lambda v: rank.get(v, 0))
+
+def test_prefix_index():
+    fd, path = tempfile.mkstemp()
+    os.write(fd, 'prelinger\nMovies\nmovie_trailers\nopensource\nmoviesandfilms\n')
+    os.close(fd)
+    try:
+        index = PrefixIndex(path, limit=2, check_interval=0)
+        assert index.complete('MOV') == ['movie_trailers', 'Movies']
+        assert index.complete('movies') == ['Movies', 'moviesandfilms']
+        assert index.complete('x') == []
+        assert index.complete('mov', rank={'moviesandfilms': 50,
+            'movie_trailers': 10}) == ['moviesandfilms', 'movie_trailers']
+
+        with open(path, 'w') as f:
+            f.write('texts\n')
+        os.utime(path, (index.mtime + 10, index.mtime + 10))
+        assert index.complete('t') == ['texts']
+        assert index.complete('mov') == []
+    finally:
+        os.unlink(path)
+
+    missing = PrefixIndex('/nonexistent/collections')
+    assert missing.complete('a') == []
@@ -0,0 +1,303 @@
+from urlparse import urlsplit, parse_qs
+from time import time, sleep
+from resource import getrusage, RUSAGE_SELF
+import json, os, sys, random, argparse, tempfile
+
+from solr_client import SolrClient, StubSolrServer
+from item_locator import ItemLocator, FakeItemServer
+from catalog import CatalogIndex, sqlite_catalog
+from disk_cache import DiskCache
+import search
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+# Drives the routes through the Flask test client against a stub Solr that
+# replays recorded replies (or synthetic ones at a realistic size), a stub
+# item server for thumbnail listings and an in-memory catalog. Reports
+# requests/second, p50/p99 latency and peak RSS per route, and compares
+# against a saved baseline.
+
+routes = [
+    ('search', '/?q=grateful+dead'),
+    ('search_movies', '/?q=prelinger&mediatype=movies'),
+    ('facets', '/facets?q=grateful+dead'),
+    ('grid', '/grid?q=*:*&collection=americana&rows=%(rows)d'),
+    ('grid_wait_admin', '/grid?wait_admin=1&rows=%(rows)d'),
+    ('facet', '/facet/collection?mediatype=texts'),
+    ('mlt', '/mlt/item0'),
+    ('collection', '/collection/americana'),
+]
+
+mediatypes = ['texts', 'movies', 'audio', 'image', 'software']
+collections = ['americana', 'prelinger', 'opensource', 'toronto', 'gutenberg',
+        'etree', 'netlabels', 'ourmedia', 'universallibrary', 'nasa']
+
+def synthetic_doc(i, rand):
+    identifier = 'item%d' % i
+    mediatype = mediatypes[i % len(mediatypes)]
+    return {
+        'identifier': identifier,
+        'title': 'Title of item %d' % i,
+        'creator': ['Creator %d' % rand.randint(0, 500)],
+        'date': '%04d-01-01T00:00:00Z' % rand.randint(1850, 2012),
+        'mediatype': mediatype,
+        'collection': rand.sample(collections, rand.randint(1, 3)),
+        'subject': ['subject %d' % rand.randint(0, 50) for j in range(3)],
+        'description': 'Description of item %d. ' % i * 10,
+        'item_size': rand.randint(10 ** 5, 10 ** 10),
+        'downloads': rand.randint(0, 10 ** 5),
+        'item_filename': ['%s_%04d.%s' % (identifier, j,
+            rand.choice(['jpg', 'png', 'gif', 'mp3', 'pdf', 'xml']))
+            for j in range(30)] + [identifier + '__ia_thumb.jpg'],
+    }
+
+def synthetic_fixtures(docs=5000, seed=1):
+    rand = random.Random(seed)
+    all_docs = [synthetic_doc(i, rand) for i in range(docs)]
+    facet_fields = dict((f, [['%s value %d' % (f, j), 10000 - j]
+        for j in range(20)]) for f in search.facet_fields)
+    facet_fields['collection_facet'] = [[c, 1000] for c in collections]
+    select = {
+        'responseHeader': {'status': 0, 'QTime': 5},
+        'response': {'numFound': 1000000, 'start': 0, 'docs': all_docs},
+        'highlighting': dict((d['identifier'], {'title':
+            ['{{{Title}}} of item']}) for d in all_docs),
+        'facet_counts': {'facet_fields': facet_fields, 'facet_ranges':
+            {'date': {'counts': [['%04d-01-01T00:00:00Z' % y, 100]
+                for y in range(1850, 2015, 10)]}}},
+        'spellcheck': {'suggestions': []},
+        'stats': {'stats_fields': dict((f, {'min': 0, 'max': 100, 'sum': 1000,
+            'count': 10, 'missing': 0, 'sumOfSquares': 0, 'mean': 10,
+            'stddev': 1}) for f in ('item_size', 'downloads'))},
+    }
+    facet = {
+        'responseHeader': {'status': 0, 'QTime': 50},
+        'response': {'numFound': 1000000, 'start': 0, 'docs': []},
+        'facet_counts': {'facet_fields': {'collection_facet':
+            [['collection%d' % j, 100000 - j] for j in range(20000)]}},
+    }
+    return {'select': select, 'facet': facet,
+            'mlt': {'match': {'numFound': 1, 'docs': all_docs[:1]},
+                'response': {'numFound': 200, 'start': 0,
+                    'docs': all_docs[:200]}}}
+
+def load_fixtures(path):
+    # recorded replies saved as <kind>.json override the synthetic ones
+    fixtures = synthetic_fixtures()
+    if path:
+        for kind in fixtures:
+            filename = os.path.join(path, kind + '.json')
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    fixtures[kind] = json.load(f)
+    return fixtures
+
+def request_kind(path, params):
+    if path.startswith('/solr/mlt'):
+        return 'mlt'
+    if params.get('qf') == ['identifier']:
+        return 'collections'
+    if params.get('facet.limit') == ['-1'] and params.get('rows') == ['0']:
+        return 'facet'
+    return 'select'
+
+def fixture_handler(fixtures, latency=0, record=None, solr_addr=None):
+    # record: directory to save the real Solr reply for each kind the first
+    # time it is seen
+    client = SolrClient()
+    def handler(method, path, body):
+        (scheme, netloc, path, query, fragment) = urlsplit(path)
+        params = parse_qs(body if method == 'POST' else query)
+        kind = request_kind(path, params)
+        if record and kind != 'collections':
+            filename = os.path.join(record, kind + '.json')
+            if not os.path.exists(filename):
+                url = 'http://' + solr_addr + path + ('?' + query
+                        if query else '')
+                reply = client.fetch(url, body)
+                with open(filename, 'w') as f:
+                    f.write(reply)
+        if latency:
+            sleep(latency)
+        if kind == 'collections':
+            ids = [i for i in params['q'][0].split(' OR ')]
+            return (200, json.dumps({'response': {'numFound': len(ids),
+                'start': 0, 'docs': [{'identifier': i, 'title': i.title()}
+                    for i in ids]}}))
+        reply = dict(fixtures[kind])
+        if kind == 'select':
+            rows = int(params.get('rows', ['10'])[0])
+            response = dict(reply['response'])
+            response['docs'] = response['docs'][:rows]
+            reply['response'] = response
+        return (200, json.dumps(reply))
+    return handler
+
+def listing_handler(latency=0):
+    def handler(method, path, body):
+        if latency:
+            sleep(latency)
+        identifier = path.split('/')[3]
+        if path.endswith('.thumbs/'):
+            return (200, ''.join('<a href="%s_%06d.jpg">x</a>\n' %
+                (identifier, i) for i in range(20)))
+        return (200, '<a href="%s.thumbs/">x</a>\n<a href="%s_thumb.jpg">'
+                'x</a>\n' % (identifier, identifier))
+    return handler
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Environment(object):
+    # points search.py's module settings at the stubs; close() puts them
+    # back
+
+    names = ('addr', 'cache_addr', 'solr_select_url', 'locator', 'catalog',
+            'thumb_cache', 'item_url', 'server_timing_header')
+
+    def __init__(self, fixtures, latency=0, docs=5000, record=None,
+            solr_addr=None):
+        self.saved = dict((name, getattr(search, name))
+                for name in self.names)
+        self.solr = StubSolrServer(fixture_handler(fixtures, latency, record,
+            solr_addr))
+        self.web = StubSolrServer(listing_handler(latency))
+        self.items = FakeItemServer(dict(('item%d' % i,
+            ('ia600100.us.archive.org', '/1/items/item%d' % i))
+            for i in range(docs)))
+        search.addr = search.cache_addr = self.solr.addr
+        search.solr_select_url = 'http://' + self.solr.addr + '/solr/select'
+        search.locator = ItemLocator(addr=self.items.addr, timeout=0.5)
+        db = sqlite_catalog([('item%d' % i, i % 3) for i in range(docs)])
+        search.catalog = CatalogIndex(lambda: db)
+        search.thumb_cache = DiskCache(':memory:')
+        search.item_url = lambda host, path: 'http://' + self.web.addr + path
+
+    def clear_caches(self):
+        search.result_cache.clear()
+        search.facet_cache.clear()
+        search.stats_cache.clear()
+        search.collection_cache.clear()
+        search.thumb_cache.close()
+        search.thumb_cache = DiskCache(':memory:')
+        search.locator.cache.clear()
+
+    def close(self):
+        search.locator.close()
+        for name, value in self.saved.items():
+            setattr(search, name, value)
+        self.items.close()
+        self.web.close()
+        self.solr.close()
+
+def run_benchmark(env, iterations=10, rows=1000, warm=False, names=None):
+    client = search.app.test_client()
+    report = {}
+    for name, url in routes:
+        if names and name not in names:
+            continue
+        url = url % {'rows': rows}
+        times = []
+        t_start = time()
+        for i in range(iterations):
+            if not warm:
+                env.clear_caches()
+            t0 = time()
+            response = client.get(url)
+            if response.status_code != 200:
+                raise AssertionError('%s: HTTP %d' % (url,
+                    response.status_code))
+            ''.join(response.response)
+            times.append(time() - t0)
+        report[name] = {
+            'requests_per_second': iterations / (time() - t_start),
+            'p50': percentile(times, 0.5),
+            'p99': percentile(times, 0.99),
+            # ru_maxrss is the process high-water mark so far, in KB
+            'peak_rss_kb': getrusage(RUSAGE_SELF).ru_maxrss,
+        }
+    return report
+
+def compare(report, baseline, threshold=0.2):
+    # lines describing each route against the baseline, and whether any
+    # p50 got worse by more than threshold
+    lines = []
+    regressed = False
+    for name in sorted(report):
+        cur = report[name]
+        line = '%-16s %8.1f req/s  p50 %7.1fms  p99 %7.1fms  rss %dKB' % (
+                name, cur['requests_per_second'], cur['p50'] * 1000,
+                cur['p99'] * 1000, cur['peak_rss_kb'])
+        old = baseline.get(name)
+        if old:
+            change = (cur['p50'] - old['p50']) / old['p50']
+            line += '  p50 %+.0f%%' % (change * 100)
+            if change > threshold:
+                line += ' REGRESSION'
+                regressed = True
+        lines.append(line)
+    return lines, regressed
+
+def test_run_benchmark():
+    env = Environment(synthetic_fixtures(docs=50), docs=50)
+    try:
+        report = run_benchmark(env, iterations=2, rows=20)
+    finally:
+        env.close()
+    assert sorted(report) == sorted(name for name, url in routes)
+    assert all(r['p50'] > 0 for r in report.values())
+    slower = dict((k, dict(v, p50=v['p50'] * 2))
+            for k, v in report.items())
+    lines, regressed = compare(slower, report)
+    assert regressed and 'REGRESSION' in lines[0]
+    assert not compare(report, report)[1]
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the routes')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=1000,
+            help='rows per /grid page')
+    parser.add_argument('--docs', type=int, default=5000,
+            help='docs in the synthetic fixtures')
+    parser.add_argument('--latency', type=float, default=0,
+            help='seconds added to every stub Solr and item server reply')
+    parser.add_argument('--fixtures', help='directory of recorded replies')
+    parser.add_argument('--record', metavar='SOLR',
+            help='host:port of a real Solr; saves its replies into --fixtures')
+    parser.add_argument('--warm', action='store_true',
+            help="don't clear the caches between requests")
+    parser.add_argument('--route', action='append',
+            help='only run this route (repeatable)')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--save', help='write the report as JSON')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.record and not args.fixtures:
+        parser.error('--record needs --fixtures')
+    fixtures = synthetic_fixtures(args.docs)
+    if args.fixtures and not args.record:
+        fixtures = load_fixtures(args.fixtures)
+    env = Environment(fixtures, args.latency, args.docs,
+            record=args.fixtures if args.record else None,
+            solr_addr=args.record)
+    try:
+        report = run_benchmark(env, args.iterations, args.rows, args.warm,
+                args.route)
+    finally:
+        env.close()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    lines, regressed = compare(report, baseline, args.threshold)
+    print '\n'.join(lines)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
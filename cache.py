@@ -0,0 +1,146 @@
+from collections import OrderedDict, defaultdict
+from threading import Lock
+from time import time
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class LRUCache(object):
+    def __init__(self, max_size=1000, ttl=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, size, value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time():
+                self.size -= size
+                self.removed(key)
+                self.misses += 1
+                return default
+            self.data[key] = (expires, size, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time() + ttl if ttl is not None else None
+        size = self.sizeof(value) if self.sizeof else 1
+        with self.lock:
+            if key in self.data:
+                self.size -= self.data.pop(key)[1]
+                self.removed(key)
+            if size > self.max_size:
+                return
+            self.data[key] = (expires, size, value)
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (expires, size, value) = self.data.popitem(last=False)
+                self.size -= size
+                self.removed(old_key)
+
+    def removed(self, key):
+        # called with the lock held whenever an entry leaves the cache
+        pass
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.data:
+                self.size -= self.data.pop(key)[1]
+                self.removed(key)
+
+    def clear(self):
+        with self.lock:
+            for key in self.data:
+                self.removed(key)
+            self.data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.data),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+class TaggedCache(LRUCache):
+    # LRUCache where each entry can carry tags, so every entry with a given
+    # tag can be dropped at once.
+
+    def __init__(self, *args, **kwargs):
+        LRUCache.__init__(self, *args, **kwargs)
+        self.tags = defaultdict(set)
+        self.key_tags = {}
+
+    def set(self, key, value, ttl=None, tags=()):
+        LRUCache.set(self, key, value, ttl)
+        with self.lock:
+            if key not in self.data:
+                return
+            self.key_tags[key] = set(tags)
+            for tag in tags:
+                self.tags[tag].add(key)
+
+    def removed(self, key):
+        for tag in self.key_tags.pop(key, ()):
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, tag):
+        with self.lock:
+            keys = list(self.tags.get(tag, ()))
+        for key in keys:
+            self.discard(key)
+        return len(keys)
+
+def test_lru_cache():
+    c = LRUCache(max_size=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    assert c.get('a') == 1
+    c.set('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+    assert c.stats()['hits'] == 3 and c.stats()['misses'] == 1
+
+def test_lru_cache_ttl_and_sizeof():
+    c = LRUCache(max_size=10, ttl=60, sizeof=len)
+    c.set('a', 'xxxx')
+    c.set('b', 'yyyy')
+    c.set('c', 'zzzz')
+    assert c.get('a') is None
+    assert c.size == 8
+    c.set('d', 'x' * 11)
+    assert c.get('d') is None
+    c.set('e', 'old', ttl=-1)
+    assert c.get('e') is None
+
+def test_tagged_cache():
+    c = TaggedCache(max_size=3)
+    c.set('a', 1, tags=['movies', 'prelinger'])
+    c.set('b', 2, tags=['movies'])
+    c.set('c', 3, tags=['texts'])
+    assert c.invalidate('movies') == 2
+    assert c.get('a') is None and c.get('b') is None and c.get('c') == 3
+    assert 'prelinger' not in c.tags
+    c.set('d', 4, tags=['x'])
+    c.set('e', 5)
+    c.set('f', 6)
+    assert c.get('c') is None and 'texts' not in c.tags
+    assert c.invalidate('nosuch') == 0
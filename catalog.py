@@ -0,0 +1,134 @@
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Thread, Lock
+from time import time
+import sqlite3
+
+import metrics
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class CatalogIndex(object):
+    # In-memory copy of catalog.wait_admin as wait_admin -> sorted list of
+    # identifiers. The first request loads it; after that a stale index is
+    # served while a background thread reloads it, so no request waits on
+    # the full-table query. connect() returns a DB-API connection, which
+    # is kept open and reused between refreshes.
+
+    def __init__(self, connect, refresh_interval=300):
+        self.connect = connect
+        self.refresh_interval = refresh_interval
+        self.conn = None
+        self.by_wait_admin = {}
+        self.version = 0
+        self.loaded = None
+        self.refreshing = False
+        self.lock = Lock()
+        self.load_lock = Lock()
+
+    def fetch_rows(self):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self.connect()
+            try:
+                with metrics.timer('catalog_fetch'):
+                    cur = self.conn.cursor()
+                    cur.execute('select identifier, wait_admin from catalog')
+                    return cur.fetchall()
+            except Exception:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+                if attempt:
+                    raise
+
+    def load(self):
+        by_wait_admin = defaultdict(list)
+        for identifier, wait_admin in self.fetch_rows():
+            by_wait_admin[wait_admin].append(identifier)
+        for identifiers in by_wait_admin.itervalues():
+            identifiers.sort()
+        all_identifiers = sorted(set(identifier
+            for identifiers in by_wait_admin.itervalues()
+            for identifier in identifiers))
+        with self.lock:
+            self.by_wait_admin = dict(by_wait_admin)
+            self.by_wait_admin['*'] = all_identifiers
+            self.version += 1
+            self.loaded = time()
+            self.refreshing = False
+
+    def refresh(self):
+        with self.load_lock:
+            self.load()
+
+    def background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            with self.lock:
+                self.refreshing = False
+
+    def ensure_loaded(self):
+        if self.loaded is None:
+            with self.load_lock:
+                if self.loaded is None:
+                    self.load()
+            return
+        with self.lock:
+            if self.refreshing or \
+                    time() - self.loaded < self.refresh_interval:
+                return
+            self.refreshing = True
+        t = Thread(target=self.background_refresh)
+        t.daemon = True
+        t.start()
+
+    def identifiers(self, wait_admin='*'):
+        self.ensure_loaded()
+        if wait_admin != '*':
+            wait_admin = int(wait_admin)
+        return self.by_wait_admin.get(wait_admin, [])
+
+    def states(self, identifiers):
+        # identifier -> set of wait_admin values, for just these identifiers
+        self.ensure_loaded()
+        found = defaultdict(set)
+        for wait_admin, catalog in self.by_wait_admin.iteritems():
+            if wait_admin == '*':
+                continue
+            for identifier in identifiers:
+                i = bisect_left(catalog, identifier)
+                if i < len(catalog) and catalog[i] == identifier:
+                    found[identifier].add(wait_admin)
+        return found
+
+def sqlite_catalog(rows):
+    # stand-in for the catalog table in tests
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.execute('create table catalog (identifier text, wait_admin integer)')
+    db.executemany('insert into catalog values (?, ?)', rows)
+    db.commit()
+    return db
+
+def test_catalog_index():
+    db = sqlite_catalog([('b', 1), ('a', 1), ('c', 2), ('a', 2), ('d', 9)])
+    connects = []
+    def connect():
+        connects.append(1)
+        return db
+    catalog = CatalogIndex(connect)
+    assert catalog.identifiers(1) == ['a', 'b']
+    assert catalog.identifiers('2') == ['a', 'c']
+    assert catalog.identifiers(0) == []
+    assert catalog.identifiers('*') == ['a', 'b', 'c', 'd']
+    assert catalog.states(['a', 'd', 'x']) == {'a': set([1, 2]), 'd': set([9])}
+    assert catalog.version == 1
+
+    db.execute("insert into catalog values ('e', 0)")
+    catalog.refresh()
+    assert catalog.identifiers(0) == ['e']
+    assert catalog.version == 2
+    assert len(connects) == 1
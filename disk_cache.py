@@ -0,0 +1,209 @@
+from threading import Thread, Lock
+from time import time, sleep
+import json, sqlite3, os, tempfile
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class DiskCache(object):
+    # sqlite backed key -> JSON value store that survives restarts.
+    # Entries younger than fresh_for are served as is; entries younger than
+    # stale_for are served immediately and refreshed in the background;
+    # anything older is fetched before returning. Least recently used rows
+    # are dropped once there are more than max_entries. sqlite errors (an
+    # unwritable path, a locked database) fall back to an uncached fetch.
+
+    def __init__(self, path, max_entries=100000, fresh_for=86400,
+            stale_for=86400 * 30):
+        self.path = path
+        self.max_entries = max_entries
+        self.fresh_for = fresh_for
+        self.stale_for = stale_for
+        self.db = None
+        self.lock = Lock()
+        self.refreshing = set()
+        self.touched = {}
+        self.inserts = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def connect(self):
+        if self.db is None:
+            db = sqlite3.connect(self.path, timeout=1,
+                    check_same_thread=False)
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+            db.execute('create table if not exists cache (key text primary key,'
+                ' value text, fetched real, accessed real)')
+            db.execute('create index if not exists cache_accessed'
+                ' on cache (accessed)')
+            db.commit()
+            self.db = db
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def __len__(self):
+        with self.lock:
+            return self.connect().execute('select count(*) from cache') \
+                    .fetchone()[0]
+
+    def lookup(self, key):
+        with self.lock:
+            db = self.connect()
+            row = db.execute('select value, fetched, accessed from cache'
+                ' where key=?', (key,)).fetchone()
+            if not row:
+                return None
+            now = time()
+            if now - row[2] > 60:
+                self.touched[key] = now
+                if len(self.touched) >= 100:
+                    self.flush_touched(db)
+                    db.commit()
+        return (json.loads(row[0]), now - row[1])
+
+    def cached_keys(self, keys):
+        # Which of keys have an entry, in one query per 500 keys; doesn't
+        # count as an access.
+        keys = list(keys)
+        found = set()
+        with self.lock:
+            db = self.connect()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                found.update(key for (key,) in db.execute('select key from'
+                    ' cache where key in (%s)' % ','.join('?' * len(chunk)),
+                    chunk))
+        return found
+
+    def flush_touched(self, db):
+        if self.touched:
+            db.executemany('update cache set accessed=? where key=?',
+                    [(t, key) for key, t in self.touched.iteritems()])
+            self.touched.clear()
+
+    def set(self, key, value):
+        now = time()
+        with self.lock:
+            db = self.connect()
+            db.execute('insert or replace into cache values (?, ?, ?, ?)',
+                    (key, json.dumps(value), now, now))
+            self.touched.pop(key, None)
+            self.inserts += 1
+            if self.inserts % 100 == 0:
+                self.flush_touched(db)
+                self.evict(db)
+            db.commit()
+
+    def evict(self, db):
+        excess = db.execute('select count(*) from cache').fetchone()[0] - \
+                self.max_entries
+        if excess > 0:
+            db.execute('delete from cache where key in (select key from cache'
+                ' order by accessed limit ?)', (excess,))
+
+    def trim(self):
+        with self.lock:
+            db = self.connect()
+            self.flush_touched(db)
+            self.evict(db)
+            db.commit()
+
+    def refresh(self, key, fetch):
+        try:
+            self.set(key, fetch())
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key, fetch):
+        try:
+            found = self.lookup(key)
+        except sqlite3.Error:
+            self.count('errors')
+            found = None
+        if found:
+            value, age = found
+            if age < self.fresh_for:
+                self.count('hits')
+                return value
+            if age < self.stale_for:
+                with self.lock:
+                    self.stale_hits += 1
+                    if key in self.refreshing:
+                        return value
+                    self.refreshing.add(key)
+                t = Thread(target=self.refresh, args=(key, fetch))
+                t.daemon = True
+                t.start()
+                return value
+        self.count('misses')
+        value = fetch()
+        try:
+            self.set(key, value)
+        except sqlite3.Error:
+            self.count('errors')
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'errors': self.errors,
+            }
+
+def test_disk_cache():
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    calls = []
+    def fetch(value):
+        def f():
+            calls.append(value)
+            return value
+        return f
+    try:
+        cache = DiskCache(path, fresh_for=60, stale_for=3600)
+        assert cache.get('a', fetch({'imgs': [1, 2]})) == {'imgs': [1, 2]}
+        assert cache.get('a', fetch('new')) == {'imgs': [1, 2]}
+        assert calls == [{'imgs': [1, 2]}]
+        cache.close()
+
+        cache = DiskCache(path, fresh_for=0, stale_for=3600)
+        assert cache.get('a', fetch('new')) == {'imgs': [1, 2]}
+        for attempt in range(50):
+            if not cache.refreshing:
+                break
+            sleep(0.02)
+        assert cache.lookup('a')[0] == 'new'
+        assert cache.stats() == \
+                {'hits': 0, 'stale_hits': 1, 'misses': 0, 'errors': 0}
+        assert cache.cached_keys(['a', 'b']) == set(['a'])
+
+        cache.max_entries = 10
+        for i in range(100):
+            cache.set('key%d' % i, i)
+        cache.trim()
+        assert len(cache) == 10
+        assert cache.lookup('key99')[0] == 99
+        cache.close()
+    finally:
+        os.unlink(path)
+
+def test_disk_cache_unusable_path():
+    cache = DiskCache('/nonexistent/dir/cache.sqlite')
+    assert cache.get('a', lambda: 'value') == 'value'
+    assert cache.stats()['errors'] == 2
@@ -0,0 +1,80 @@
+from StringIO import StringIO
+import csv, json
+
+from parallel import Background
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+def export_docs(fetch_page, rows):
+    # Walks a result set in identifier order. fetch_page(after) returns up
+    # to rows docs with identifier > after, sorted by identifier; the next
+    # page is requested while the current one is being written out.
+    pending = Background(fetch_page, None)
+    while pending:
+        docs = pending.result()
+        if len(docs) == rows:
+            pending = Background(fetch_page, docs[-1]['identifier'])
+        else:
+            pending = None
+        for doc in docs:
+            yield doc
+
+def fmt_value(v):
+    if v is None:
+        return u''
+    if isinstance(v, list):
+        return u'; '.join(unicode(i) for i in v)
+    return unicode(v)
+
+def export_txt(docs, fields):
+    for doc in docs:
+        yield u'\t'.join(fmt_value(doc.get(f)) for f in fields) \
+                .encode('utf-8') + '\r\n'
+
+def export_csv(docs, fields):
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow([f.encode('utf-8') for f in fields])
+    for doc in docs:
+        writer.writerow([fmt_value(doc.get(f)).encode('utf-8')
+            for f in fields])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+def export_jsonl(docs, fields):
+    for doc in docs:
+        yield json.dumps(dict((f, doc[f]) for f in fields if f in doc)) + '\n'
+
+export_formats = {
+    'txt': (export_txt, 'text/plain; charset=utf-8', 'txt'),
+    'csv': (export_csv, 'text/csv; charset=utf-8', 'csv'),
+    'json': (export_jsonl, 'application/x-json-stream', 'jsonl'),
+}
+
+def test_export_docs():
+    identifiers = ['item%03d' % i for i in range(25)]
+    calls = []
+    def fetch_page(after):
+        calls.append(after)
+        return [{'identifier': i} for i in identifiers
+                if after is None or i > after][:10]
+    docs = list(export_docs(fetch_page, 10))
+    assert [doc['identifier'] for doc in docs] == identifiers
+    assert calls == [None, 'item009', 'item019']
+
+    calls = []
+    identifiers = identifiers[:20]
+    assert len(list(export_docs(fetch_page, 10))) == 20
+    assert calls == [None, 'item009', 'item019']
+
+def test_export_formats():
+    docs = [{'identifier': 'a', 'title': u'caf\xe9', 'collection': ['x', 'y']},
+            {'identifier': 'b'}]
+    fields = ['identifier', 'title', 'collection']
+    assert ''.join(export_txt(docs, ['identifier'])) == 'a\r\nb\r\n'
+    assert ''.join(export_csv(docs, fields)) == \
+        'identifier,title,collection\r\na,caf\xc3\xa9,x; y\r\nb,,\r\n'
+    lines = ''.join(export_jsonl(docs, fields)).splitlines()
+    assert json.loads(lines[0]) == docs[0]
+    assert json.loads(lines[1]) == {'identifier': 'b'}
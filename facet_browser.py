@@ -0,0 +1,58 @@
+from bisect import bisect_left
+from threading import Lock
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class FacetSnapshot(object):
+    # Every (value, count) of one facet under one set of filters, in Solr's
+    # count order. Index order and prefix ranges are worked out from it on
+    # demand, so paging, re-sorting and A-Z jumps never go back to Solr.
+
+    def __init__(self, counts, total):
+        self.counts = [tuple(i) for i in counts]
+        self.total = total
+        self.by_value = None
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def index_order(self):
+        with self.lock:
+            if self.by_value is None:
+                self.by_value = sorted(self.counts)
+            return self.by_value
+
+    def initials(self):
+        return sorted(set(value[:1] for value, count in self.index_order()))
+
+    def page(self, offset, limit, sort='count', prefix=None):
+        # returns (the page of counts, how many values there are in all)
+        if prefix:
+            ordered = self.index_order()
+            start = bisect_left(ordered, (prefix,))
+            end = bisect_left(ordered, (prefix + u'\uffff',), start)
+            items = ordered[start:end]
+            if sort == 'count':
+                items = sorted(items, key=lambda i: -i[1])
+        elif sort == 'count':
+            items = self.counts
+        else:
+            items = self.index_order()
+        return (items[offset:offset + limit], len(items))
+
+def test_facet_snapshot():
+    counts = [[u'movies', 50], [u'Texts', 40], [u'audio', 30], [u'mov', 30],
+            [u'moviesandfilms', 60]]
+    snapshot = FacetSnapshot(sorted(counts, key=lambda i: -i[1]), 1000)
+    assert len(snapshot) == 5
+    assert snapshot.page(0, 2) == \
+            ([(u'moviesandfilms', 60), (u'movies', 50)], 5)
+    assert snapshot.page(1, 2, sort='index') == \
+            ([(u'audio', 30), (u'mov', 30)], 5)
+    assert snapshot.page(0, 10, prefix=u'movies') == \
+            ([(u'moviesandfilms', 60), (u'movies', 50)], 2)
+    assert snapshot.page(1, 10, sort='index', prefix=u'mov') == \
+            ([(u'movies', 50), (u'moviesandfilms', 60)], 3)
+    assert snapshot.page(0, 10, prefix=u'x') == ([], 0)
+    assert snapshot.initials() == [u'T', u'a', u'm']
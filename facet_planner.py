@@ -0,0 +1,48 @@
+from solr_params import encode
+from field_stats import FieldStats
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+# Picks per-field facet parameters from field statistics. A field with few
+# distinct values is cheapest to facet with enum (one filterCache entry per
+# value); anything bigger is left on Solr's default fc. Enum fields with a
+# fair number of values get facet.enum.cache.minDf, so their rare values
+# don't push everything else out of the filterCache. Fields with no
+# distinct count fall back to the hand-picked list.
+
+enum_max = 200
+enum_cache_all = 50
+enum_min_df = 30
+
+def facet_method(stats, default_enum):
+    if stats is None or stats.distinct is None:
+        return 'enum' if default_enum else None
+    return 'enum' if stats.distinct <= enum_max else None
+
+def plan_facet_params(fields, field_stats, default_enum_fields=()):
+    pairs = []
+    for f in fields:
+        stats = field_stats.get(f)
+        if facet_method(stats, f in default_enum_fields) != 'enum':
+            continue
+        pairs.append(('f.' + f + '.facet.method', 'enum'))
+        if stats is not None and stats.distinct > enum_cache_all:
+            pairs.append(('f.' + f + '.facet.enum.cache.minDf', enum_min_df))
+    return encode(pairs)
+
+def test_plan_facet_params():
+    stats = {
+        'mediatype': FieldStats('mediatype', 1000, distinct=12),
+        'language_facet': FieldStats('language_facet', 500, distinct=150),
+        'creator_facet': FieldStats('creator_facet', 900, distinct=500000),
+        'noindex': FieldStats('noindex', 10),
+    }
+    defaults = set(['noindex', 'creator_facet', 'tv_channel'])
+    assert plan_facet_params(['mediatype', 'language_facet', 'creator_facet',
+        'noindex', 'tv_channel', 'subject_facet'], stats, defaults) == \
+        '&f.mediatype.facet.method=enum' \
+        '&f.language_facet.facet.method=enum' \
+        '&f.language_facet.facet.enum.cache.minDf=30' \
+        '&f.noindex.facet.method=enum' \
+        '&f.tv_channel.facet.method=enum'
+    assert plan_facet_params(['subject_facet'], stats, defaults) == ''
@@ -0,0 +1,225 @@
+from ast import literal_eval
+from threading import Lock
+from urlparse import parse_qs
+import json, os, sys, tempfile, argparse
+
+from parallel import run_parallel
+from solr_client import SolrClient, StubSolrServer
+from solr_params import encode
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class FieldStats(object):
+    # How many docs have a field, and which collections and mediatypes
+    # most of them are in, as tuples of (name, count). distinct is the
+    # number of distinct indexed values, where it has been measured.
+    __slots__ = ('field', 'count', 'top_collections', 'top_mediatypes',
+            'distinct')
+
+    def __init__(self, field, count, top_collections=(), top_mediatypes=(),
+            distinct=None):
+        self.field = field
+        self.count = count
+        self.top_collections = tuple(tuple(i) for i in top_collections)
+        self.top_mediatypes = tuple(tuple(i) for i in top_mediatypes)
+        self.distinct = distinct
+
+    def to_json(self):
+        d = {'field': self.field, 'count': self.count,
+            'top_collections': self.top_collections,
+            'top_mediatypes': self.top_mediatypes}
+        if self.distinct is not None:
+            d['distinct'] = self.distinct
+        return json.dumps(d)
+
+def pairs(flat):
+    # [u'movies', 15, u'audio', 8] -> [(u'movies', 15), (u'audio', 8)]
+    return zip(flat[::2], flat[1::2])
+
+def parse_line(line):
+    # JSON lines, or the older (count, field, [collection, count, ...],
+    # [mediatype, count, ...]) tuples
+    if line.startswith('('):
+        (count, field, top_collections, top_mediatypes) = literal_eval(line)
+        return FieldStats(field, count, pairs(top_collections),
+                pairs(top_mediatypes))
+    d = json.loads(line)
+    return FieldStats(d['field'], d['count'], d['top_collections'],
+            d['top_mediatypes'], d.get('distinct'))
+
+def read_field_stats(path):
+    with open(path) as f:
+        return dict((s.field, s) for s in
+                (parse_line(line.strip()) for line in f if line.strip()))
+
+def write_field_stats(path, stats):
+    # written to a temporary file and renamed, so readers never see half
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+            prefix='.field_stats')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for s in sorted(stats, key=lambda s: (s.count, s.field)):
+                f.write(s.to_json() + '\n')
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+class FieldCounts(object):
+    # Loads the stats file on first use, and again if it changes on disk.
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = None
+        self.mtime = None
+        self.lock = Lock()
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return self.stats or {}
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.stats = read_field_stats(self.path)
+                    self.mtime = mtime
+        return self.stats
+
+def fetch_field_stats(client, solr_url, field, top=5):
+    # one request per field: numFound is the count, the two facets give
+    # the top collections and mediatypes
+    params = 'wt=json&json.nl=arrarr&q=*:*&rows=0&facet=true' + encode([
+        ('fq', field + ':[* TO *]'),
+        ('facet.field', 'collection_facet'),
+        ('facet.field', 'mediatype'),
+        ('facet.limit', top),
+        ('facet.mincount', 1)])
+    results = json.loads(client.fetch(solr_url, params, idempotent=True))
+    facets = results['facet_counts']['facet_fields']
+    return FieldStats(field, results['response']['numFound'],
+            facets['collection_facet'], facets['mediatype'])
+
+def fetch_distinct(client, luke_url, field):
+    # number of distinct terms and docs from the Luke request handler
+    params = encode([('wt', 'json'), ('fl', field), ('numTerms', 0)])
+    info = json.loads(client.fetch(luke_url + '?' + params[1:]))
+    info = info['fields'].get(field, {})
+    return FieldStats(field, info.get('docs', 0), distinct=info.get('distinct'))
+
+def generate_field_stats(solr_url, fields, workers=8, client=None,
+        facet_fields=()):
+    # Returns ({field: FieldStats}, [fields that failed]). Fields with no
+    # docs at all are left out, as before. facet_fields also get their
+    # distinct value count, for the facet planner.
+    client = client or SolrClient()
+    luke_url = solr_url.rsplit('/', 1)[0] + '/admin/luke'
+    tasks = [(f, fetch_field_stats, (client, solr_url, f)) for f in fields]
+    tasks += [(('distinct', f), fetch_distinct, (client, luke_url, f))
+            for f in facet_fields]
+    found = run_parallel(tasks, workers=workers)
+    failed = [key for key, func, args in tasks if key not in found]
+    failed = [key[1] if isinstance(key, tuple) else key for key in failed]
+    stats = dict((f, s) for f, s in found.iteritems()
+            if not isinstance(f, tuple) and s.count)
+    for key, s in found.iteritems():
+        if isinstance(key, tuple):
+            if key[1] in stats:
+                stats[key[1]].distinct = s.distinct
+            elif s.count:
+                stats[key[1]] = s
+    return (stats, failed)
+
+def test_field_stats():
+    legacy = "(34, 'show_subcollection_icons', [u'movies', 15, u'audio', 8]," \
+            " [u'collection', 34])"
+    s = parse_line(legacy)
+    assert (s.field, s.count) == ('show_subcollection_icons', 34)
+    assert s.top_collections == ((u'movies', 15), (u'audio', 8))
+    assert s.top_mediatypes == ((u'collection', 34),)
+    again = parse_line(s.to_json())
+    assert [getattr(again, k) for k in FieldStats.__slots__] == \
+            [getattr(s, k) for k in FieldStats.__slots__]
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_field_stats(path, [s, FieldStats('title', 1000)])
+        counts = FieldCounts(path)
+        loaded = counts.get()
+        assert sorted(loaded) == ['show_subcollection_icons', 'title']
+        assert loaded['title'].count == 1000
+        assert counts.get() is loaded
+    finally:
+        os.unlink(path)
+    assert FieldCounts('/nonexistent/field_counts').get() == {}
+
+def test_generate_field_stats():
+    def handler(method, path, body):
+        if path.startswith('/solr/admin/luke'):
+            field = parse_qs(path.split('?', 1)[1])['fl'][0]
+            return (200, json.dumps({'fields': {field:
+                {'docs': 60, 'distinct': 12}}}))
+        params = parse_qs(body)
+        field = params['fq'][0].split(':')[0]
+        if field == 'broken':
+            return (500, 'error')
+        count = {'title': 100, 'runtime': 7, 'empty': 0}[field]
+        return (200, json.dumps({
+            'response': {'numFound': count, 'docs': []},
+            'facet_counts': {'facet_fields': {
+                'collection_facet': [['movies', count]],
+                'mediatype': [['movies', count]]}}}))
+    server = StubSolrServer(handler)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        solr_url = 'http://' + server.addr + '/solr/select'
+        stats, failed = generate_field_stats(solr_url,
+                ['title', 'runtime', 'empty', 'broken'], workers=2,
+                facet_fields=['runtime', 'mediatype'])
+        assert failed == ['broken']
+        assert sorted(stats) == ['mediatype', 'runtime', 'title']
+        assert stats['runtime'].top_collections == (('movies', 7),)
+        assert stats['runtime'].distinct == 12
+        assert (stats['mediatype'].count, stats['mediatype'].distinct) == \
+                (60, 12)
+        write_field_stats(path, stats.values())
+        assert read_field_stats(path)['title'].count == 100
+        assert read_field_stats(path)['mediatype'].distinct == 12
+    finally:
+        os.unlink(path)
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='field_counts for /fields')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('convert', help='convert an old-style tuple file')
+    p.add_argument('old')
+    p.add_argument('new')
+    p = sub.add_parser('generate', help='recount every field from Solr')
+    p.add_argument('output', nargs='?')
+    p.add_argument('--solr', help='host:port, defaults to the one search.py uses')
+    p.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        write_field_stats(args.new, read_field_stats(args.old).values())
+        return
+    import search
+    output = args.output or search.field_counts_path
+    solr_url = 'http://' + (args.solr or search.addr) + '/solr/select'
+    stats, failed = generate_field_stats(solr_url, search.field_set['all'],
+            workers=args.workers, facet_fields=search.facet_fields)
+    if failed:
+        # keep the previous numbers for fields that couldn't be counted
+        print >> sys.stderr, 'failed:', ' '.join(failed)
+        if os.path.exists(output):
+            old = read_field_stats(output)
+            stats.update((f, old[f]) for f in failed if f in old)
+    write_field_stats(output, stats.values())
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
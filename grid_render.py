@@ -0,0 +1,201 @@
+from itertools import islice
+from jinja2 import Markup, escape, Environment
+from jinja2.filters import do_truncate
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+mediatype_icons = {
+    'texts': 'book',
+    'movies': 'film',
+    'audio': 'headphones',
+    'image': 'picture',
+    'etree': 'music',
+    'software': 'cog',
+    'data': 'file',
+    'collection': 'list',
+    'other': 'asterisk',
+    'education': 'pencil',
+}
+
+wait_admin_labels = [
+    (2, 'label-important', 'red row'),
+    (1, 'label-info', 'blue row'),
+    (0, 'label-success', 'green row'),
+    (9, '', 'brown row'),
+]
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class GridRenderer(object):
+    # Builds the <tr> for each doc in /grid. Which cell function each
+    # column uses, and the query string for its filter links, are worked
+    # out once in __init__; row() only formats values.
+
+    def __init__(self, fields, args, changequery, quote, esc, comma,
+            fmt_filesize, single_value_fields, env=None):
+        self.fields = fields
+        self.quote = quote
+        self.esc = esc
+        self.comma = comma
+        self.fmt_filesize = fmt_filesize
+        self.env = env or Environment()
+        self.columns = []
+        for f in fields:
+            base = changequery({f: None})
+            prefix = '?' + base + ('&' if base else '') + f + '='
+            if f == 'identifier':
+                cell = self.identifier_cell
+            elif f == 'mediatype':
+                cell = self.mediatype_cell
+            elif f == 'title':
+                cell = self.title_cell
+            elif f.startswith('description') or f.startswith('case-name'):
+                cell = self.truncated_cell
+            elif f == 'item_size':
+                cell = self.filesize_cell
+            elif f not in single_value_fields:
+                cell = self.multi_value_cell
+            elif f in ('publisher', 'scanningcenter'):
+                cell = self.filter_cell
+            elif f == 'downloads':
+                cell = self.downloads_cell
+            else:
+                cell = self.value_cell
+            self.columns.append((f, cell, prefix, args.get(f, '')))
+
+    def filter_links(self, prefix, current, v):
+        plus = escape(prefix + self.quote(current + '"%s"' % v))
+        minus = escape(prefix + self.quote(current + '-"%s"' % v))
+        return ('<a href="%s"><i class="icon-plus-sign" alt="+"></i></a>'
+                '<a href="%s"><i class="icon-minus-sign" alt="-"></i></a>'
+                % (plus, minus))
+
+    def identifier_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        identifier = doc['identifier']
+        states = catalog_rows.get(identifier)
+        html = ['<a href="http://www.archive.org/details/%s" class="nowrap">'
+            '%s</a> (<a href="http://www.archive.org/catalog.php?history=1'
+            '&amp;identifier=%s">history</a>)' % ((escape(identifier),) * 3)]
+        if doc.get('thumb_path') and (states or doc.get('noindex') or
+                doc.get('access-restricted')):
+            html.append('<br>')
+        if states:
+            for state, cls, label in wait_admin_labels:
+                if state in states:
+                    html.append(' <span class="label nowrap %s">%s</span>'
+                            % (cls, label))
+        if doc.get('noindex'):
+            html.append(' <span class="label label-warning">noindex</span>')
+        if doc.get('access-restricted'):
+            html.append(' <span class="label label-warning">restricted</span>')
+        return ''.join(html)
+
+    def mediatype_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        v = doc.get('mediatype')
+        if not v:
+            return '<span class="label label-important">missing</span>'
+        icon = ''
+        if v in mediatype_icons:
+            icon = '<i class="icon-%s"></i> ' % mediatype_icons[v]
+        return '%s%s %s' % (icon, escape(v),
+                self.filter_links(prefix, current, self.esc(v)))
+
+    def title_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        title = doc.get('title', '')
+        if len(title) > 80:
+            return '<span class="nowrap" title="%s">%s</span>' % (
+                    escape(title), escape(do_truncate(self.env, title, 80)))
+        return '<span class="nowrap">%s</span>' % escape(title)
+
+    def truncated_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        v = doc.get(f, '')
+        if not isinstance(v, basestring):
+            v = unicode(v)
+        return '<span class="nowrap">%s</span>' % \
+                escape(do_truncate(self.env, v, 80))
+
+    def filesize_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        if f in doc:
+            return self.fmt_filesize(doc[f])
+        return ''
+
+    def multi_value_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        values = doc.get(f, [])
+        if not isinstance(values, list):
+            return escape(values)
+        html = []
+        for i, v in enumerate(values):
+            html.append('<span class="nowrap">%s %s</span>' % (escape(v),
+                self.filter_links(prefix, current, self.esc(v))))
+            if i == 2 and len(values) > 3:
+                html.append('<a href="#" onclick="return show_more(this, '
+                    '\'%s\');">&hellip;</a><span id="%s" class="more">'
+                    % (row_id, row_id))
+        if len(values) > 3:
+            html.append('</span>')
+        return ' '.join(html)
+
+    def filter_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        v = doc.get(f)
+        if not v:
+            return ''
+        return '%s %s' % (escape(v), self.filter_links(prefix, current, v))
+
+    def downloads_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        return self.comma(doc.get(f, 0))
+
+    def value_cell(self, doc, f, prefix, current, row_id, catalog_rows):
+        v = doc.get(f)
+        return escape(v) if v else ''
+
+    def row(self, doc, index, catalog_rows):
+        identifier = escape(doc['identifier'])
+        html = ['<tr>\n<td>']
+        if doc.get('thumb_path'):
+            html.append('<a href="http://www.archive.org/details/%s">'
+                '<img class="thumb" src="http://www.archive.org/download/%s/'
+                '%s"></a>' % (identifier, identifier,
+                    escape(doc['thumb_path'])))
+        html.append('</td>\n<td><input type="checkbox" name="selected" '
+                'value="%s"></td>\n' % identifier)
+        for f, cell, prefix, current in self.columns:
+            row_id = 'row%d_%s' % (index, f)
+            html.append('<td>')
+            html.append(cell(doc, f, prefix, current, row_id, catalog_rows))
+            html.append('</td>\n')
+        html.append('</tr>\n')
+        return Markup(u''.join(unicode(i) for i in html))
+
+def test_grid_renderer():
+    from urllib import quote_plus
+    def changequery(new_args):
+        args = {'q': 'x', 'creator': 'a'}
+        args = dict((k, v) for k, v in args.items() if k not in new_args)
+        return '&'.join('%s=%s' % (k, quote_plus(v))
+                for k, v in sorted(args.items()))
+    renderer = GridRenderer(['identifier', 'title', 'creator', 'mediatype',
+        'item_size', 'downloads', 'date'], {'creator': 'a'}, changequery,
+        quote_plus, lambda s: s.replace(':', '\\:'), str,
+        lambda n: '%d bytes' % n, set(['identifier', 'title', 'mediatype',
+            'item_size', 'downloads', 'date']))
+    doc = {'identifier': 'item1', 'title': 'T' * 100, 'mediatype': 'movies',
+        'creator': ['a', 'b:c', 'd', 'e'], 'item_size': 5, 'downloads': 7,
+        'date': '<1950>', 'thumb_path': 'x.jpg', 'noindex': True}
+    html = renderer.row(doc, 3, {'item1': set([2])})
+    assert html.count('<td>') == 9
+    assert 'label-important">red row' in html
+    assert 'label-warning">noindex' in html
+    assert '<td>5 bytes</td>' in html and '<td>7</td>' in html
+    assert '&lt;1950&gt;' in html
+    assert 'title="' + 'T' * 100 + '"' in html
+    assert '<i class="icon-film"></i> movies <a href="?creator=a&amp;q=x' \
+            '&amp;mediatype=%22movies%22">' in html
+    assert 'href="?q=x&amp;creator=a%22b%5C%3Ac%22"' in html
+    assert 'id="row3_creator" class="more"' in html
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
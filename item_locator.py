@@ -0,0 +1,190 @@
+from socket import socket, error as socket_error, timeout as socket_timeout, \
+    AF_INET, SOCK_DGRAM, SOL_UDP, SOL_SOCKET, SO_BROADCAST
+from threading import Thread, Lock, Event
+from time import time, sleep
+import re
+
+from cache import LRUCache
+import metrics
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+re_loc = re.compile('^(ia\d+\.us\.archive\.org):(/\d+/items/(.*))$')
+
+class FindItemError(Exception):
+    pass
+
+class ItemLocator(object):
+    # One shared UDP socket for every lookup. A receiver thread matches
+    # replies back to whoever is waiting on that identifier, so a page can
+    # send all of its identifiers at once and wait a single timeout.
+
+    def __init__(self, addr=('<broadcast>', 8010), timeout=2.0,
+            cache_size=20000, ttl=3600, negative_ttl=60):
+        self.addr = addr
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.cache = LRUCache(cache_size, ttl)
+        self.sock = None
+        self.lock = Lock()
+        self.pending = {}
+
+    def start(self):
+        with self.lock:
+            if self.sock is None:
+                s = socket(AF_INET, SOCK_DGRAM, SOL_UDP)
+                s.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+                # closing a socket doesn't wake a blocked recvfrom, so the
+                # receiver polls to notice close()
+                s.settimeout(0.2)
+                self.sock = s
+                self.receiver = Thread(target=self.receive_loop, args=(s,))
+                self.receiver.daemon = True
+                self.receiver.start()
+            return self.sock
+
+    def close(self):
+        with self.lock:
+            s, self.sock = self.sock, None
+        if s:
+            self.receiver.join()
+            s.close()
+
+    def receive_loop(self, s):
+        while self.sock is s:
+            try:
+                (loc, address) = s.recvfrom(1024)
+            except socket_timeout:
+                continue
+            except socket_error:
+                sleep(0.1)
+                continue
+            m = re_loc.match(loc)
+            if not m:
+                continue
+            ia = m.group(3)
+            found = (m.group(1), m.group(2))
+            self.cache.set(ia, found)
+            with self.lock:
+                for event, results in self.pending.pop(ia, []):
+                    results[ia] = found
+                    event.set()
+
+    def locate_many(self, identifiers, timeout=None):
+        results = {}
+        todo = []
+        for ia in set(identifiers):
+            found = self.cache.get(ia)
+            if found:
+                results[ia] = found
+            elif found is None:
+                todo.append(ia)
+        if not todo:
+            return results
+
+        with metrics.timer('find_item'):
+            s = self.start()
+            event = Event()
+            with self.lock:
+                for ia in todo:
+                    self.pending.setdefault(ia, []).append((event, results))
+            try:
+                for ia in todo:
+                    s.sendto(ia.encode('utf-8'), self.addr)
+                deadline = time() + (timeout if timeout is not None
+                        else self.timeout)
+                while True:
+                    with self.lock:
+                        if all(ia in results for ia in todo):
+                            break
+                        event.clear()
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    event.wait(remaining)
+            finally:
+                with self.lock:
+                    for ia in todo:
+                        if ia not in results:
+                            self.cache.set(ia, False, ttl=self.negative_ttl)
+                        waiters = [w for w in self.pending.get(ia, [])
+                                if w[1] is not results]
+                        if waiters:
+                            self.pending[ia] = waiters
+                        else:
+                            self.pending.pop(ia, None)
+        return dict(results)
+
+    def locate(self, ia, timeout=None):
+        found = self.locate_many([ia], timeout=timeout).get(ia)
+        if not found:
+            raise FindItemError
+        return found
+
+class FakeItemServer(object):
+    # Stands in for the storage nodes in tests: answers lookups on
+    # localhost from a dict of identifier -> (host, path).
+
+    def __init__(self, locations, delay=0):
+        self.locations = locations
+        self.delay = delay
+        self.requests = []
+        self.closed = False
+        self.sock = socket(AF_INET, SOCK_DGRAM, SOL_UDP)
+        self.sock.settimeout(0.2)
+        self.sock.bind(('127.0.0.1', 0))
+        self.addr = self.sock.getsockname()
+        self.thread = Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            try:
+                (ia, address) = self.sock.recvfrom(1024)
+            except socket_timeout:
+                continue
+            self.requests.append(ia)
+            if ia not in self.locations:
+                continue
+            if self.delay:
+                sleep(self.delay)
+            host, path = self.locations[ia]
+            self.sock.sendto(host + ':' + path, address)
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.sock.close()
+
+def test_locate_many():
+    server = FakeItemServer({
+        'foo': ('ia600100.us.archive.org', '/1/items/foo'),
+        'bar': ('ia700200.us.archive.org', '/22/items/bar'),
+    })
+    locator = ItemLocator(addr=server.addr, timeout=0.5)
+    try:
+        t0 = time()
+        found = locator.locate_many(['foo', 'bar', 'missing'])
+        assert time() - t0 < 1.0
+        assert found == {
+            'foo': ('ia600100.us.archive.org', '/1/items/foo'),
+            'bar': ('ia700200.us.archive.org', '/22/items/bar'),
+        }
+        assert sorted(server.requests) == ['bar', 'foo', 'missing']
+
+        assert locator.locate('foo') == found['foo']
+        assert len(server.requests) == 3
+        try:
+            locator.locate('missing', timeout=0.1)
+        except FindItemError:
+            pass
+        else:
+            assert False
+        assert len(server.requests) == 3
+        assert not locator.pending
+    finally:
+        locator.close()
+        server.close()
+    assert not locator.receiver.is_alive()
+    assert not server.thread.is_alive()
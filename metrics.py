@@ -0,0 +1,157 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, local
+from time import time
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+# Process-wide counters and latency histograms, plus a per-request list of
+# stage timings for the Server-Timing header. Stage timings follow work
+# onto other threads when the thread is started with bind().
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics(object):
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.lock = Lock()
+        self.local = local()
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms[key].observe(value)
+
+    def start_request(self):
+        self.local.stages = []
+        return self.local.stages
+
+    def current(self):
+        return getattr(self.local, 'stages', None)
+
+    def bind(self, func):
+        # func, run on another thread, reports its stages to this request
+        stages = self.current()
+        def bound(*args):
+            self.local.stages = stages
+            try:
+                return func(*args)
+            finally:
+                self.local.stages = None
+        return bound
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        t0 = time()
+        try:
+            yield
+        finally:
+            duration = time() - t0
+            self.observe('stage_seconds', duration, stage=stage, **labels)
+            stages = self.current()
+            if stages is not None:
+                stages.append((stage, duration))
+
+    def timed(self, stage, **labels):
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                with self.timer(stage, **labels):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            return wrapper
+        return decorator
+
+    def server_timing(self, stages):
+        totals = defaultdict(float)
+        order = []
+        for stage, duration in stages:
+            if stage not in totals:
+                order.append(stage)
+            totals[stage] += duration
+        return ', '.join('%s;dur=%.1f' % (stage, totals[stage] * 1000)
+                for stage in order)
+
+    def render(self):
+        # Prometheus text exposition format
+        def fmt_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in labels) + '}'
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(h.counts), h.total, h.count))
+                    for k, h in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, fmt_labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            cumulative = 0
+            for le, n in zip(buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (name,
+                    fmt_labels(labels, [('le', le)]), cumulative))
+            lines.append('%s_sum%s %f' % (name, fmt_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, fmt_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+count = metrics.count
+observe = metrics.observe
+timer = metrics.timer
+timed = metrics.timed
+bind = metrics.bind
+
+def test_metrics():
+    from threading import Thread
+    m = Metrics()
+    stages = m.start_request()
+    with m.timer('solr'):
+        pass
+    @m.timed('find_item')
+    def work():
+        pass
+    t = Thread(target=m.bind(work))
+    t.start()
+    t.join()
+    m.count('requests_total', endpoint='grid_page', status=200)
+    m.observe('request_seconds', 0.3, endpoint='grid_page')
+    assert [s for s, d in stages] == ['solr', 'find_item']
+    assert m.server_timing([('solr', 0.01), ('render', 0.002),
+        ('solr', 0.02)]) == 'solr;dur=30.0, render;dur=2.0'
+    text = m.render()
+    assert 'requests_total{endpoint="grid_page",status="200"} 1\n' in text
+    assert 'request_seconds_bucket{endpoint="grid_page",le="0.25"} 0\n' in text
+    assert 'request_seconds_bucket{endpoint="grid_page",le="0.5"} 1\n' in text
+    assert 'request_seconds_count{endpoint="grid_page"} 1\n' in text
+    assert 'stage_seconds_count{stage="solr"} 1\n' in text
@@ -0,0 +1,237 @@
+from threading import Thread, Condition, Event
+from Queue import Queue, Empty
+from time import time, sleep
+
+import metrics
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+def run_parallel(tasks, workers=8, timeout=None):
+    # tasks is a list of (key, func, args). Returns {key: result} for the
+    # tasks that finished within the timeout; failures and stragglers are
+    # left out. Worker threads are daemons, so a straggler never holds up
+    # the caller, and once the deadline passes they stop taking new tasks.
+    tasks = list(tasks)
+    results = {}
+    if not tasks:
+        return results
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+    state = {'finished': 0}
+    cond = Condition()
+    cancelled = Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                key, func, args = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                value = func(*args)
+                ok = True
+            except Exception:
+                ok = False
+            with cond:
+                if ok:
+                    results[key] = value
+                state['finished'] += 1
+                cond.notify()
+
+    for i in range(min(workers, len(tasks))):
+        t = Thread(target=metrics.bind(worker))
+        t.daemon = True
+        t.start()
+
+    deadline = time() + timeout if timeout is not None else None
+    with cond:
+        while state['finished'] < len(tasks):
+            if deadline is None:
+                cond.wait()
+                continue
+            remaining = deadline - time()
+            if remaining <= 0:
+                cancelled.set()
+                break
+            cond.wait(remaining)
+        return dict(results)
+
+class Background(object):
+    # Runs func(*args) on a daemon thread; result() waits for it and
+    # returns the value or re-raises the exception.
+
+    def __init__(self, func, *args):
+        self.done = Event()
+        self.value = None
+        self.error = None
+        t = Thread(target=metrics.bind(self.run), args=(func, args))
+        t.daemon = True
+        t.start()
+
+    def run(self, func, args):
+        try:
+            self.value = func(*args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def result(self, timeout=None):
+        self.done.wait(timeout)
+        if not self.done.is_set():
+            raise RuntimeError('background task timed out')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class QueryTimeout(Exception):
+    pass
+
+class QueryPlan(object):
+    # Runs a page's queries as soon as the queries they depend on are done.
+    # A query is func(*results of its deps). run() waits until everything
+    # has finished or the budget is spent; result(name) then returns the
+    # value, re-raises the query's exception, or raises QueryTimeout.
+    # timings records (start, duration) per query relative to run().
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.tasks = []
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        self.elapsed = None
+
+    def add(self, name, func, deps=()):
+        self.tasks.append((name, func, tuple(deps)))
+
+    def run(self):
+        t0 = time()
+        deadline = t0 + self.budget if self.budget is not None else None
+        cond = Condition()
+        waiting = list(self.tasks)
+        running = set()
+
+        def call(name, func, args):
+            start = time()
+            try:
+                value = func(*args)
+                error = None
+            except Exception as e:
+                error = e
+            with cond:
+                self.timings[name] = (start - t0, time() - start)
+                if error is None:
+                    self.results[name] = value
+                else:
+                    self.errors[name] = error
+                running.discard(name)
+                cond.notify()
+
+        with cond:
+            while True:
+                for task in list(waiting):
+                    name, func, deps = task
+                    if any(d in self.errors for d in deps):
+                        waiting.remove(task)
+                        self.errors[name] = QueryTimeout(name)
+                    elif all(d in self.results for d in deps):
+                        waiting.remove(task)
+                        running.add(name)
+                        t = Thread(target=metrics.bind(call), args=(name, func,
+                            [self.results[d] for d in deps]))
+                        t.daemon = True
+                        t.start()
+                if not running:
+                    break
+                if deadline is None:
+                    cond.wait()
+                    continue
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+            self.elapsed = time() - t0
+            self.results = dict(self.results)
+            self.errors = dict(self.errors)
+        return self
+
+    def result(self, name):
+        if name in self.results:
+            return self.results[name]
+        if name in self.errors:
+            raise self.errors[name]
+        raise QueryTimeout(name)
+
+    def timing_breakdown(self):
+        return sorted((name, duration)
+            for name, (start, duration) in self.timings.items())
+
+def test_run_parallel():
+    def slow(n):
+        sleep(n)
+        return n
+    def fail():
+        raise ValueError
+    t0 = time()
+    tasks = [('a', slow, (0.2,)), ('b', slow, (0.2,)), ('c', slow, (0.2,)),
+            ('d', fail, ()), ('e', slow, (5,))]
+    results = run_parallel(tasks, workers=5, timeout=1)
+    assert results == {'a': 0.2, 'b': 0.2, 'c': 0.2}
+    assert time() - t0 < 2
+
+def test_run_parallel_cancels_at_deadline():
+    started = []
+    def slow(n):
+        started.append(n)
+        sleep(0.2)
+        return n
+    tasks = [(i, slow, (i,)) for i in range(20)]
+    results = run_parallel(tasks, workers=2, timeout=0.5)
+    assert len(results) <= 6
+    sleep(0.5)
+    assert len(started) <= 6
+
+def test_background():
+    t0 = time()
+    a = Background(sleep, 0.2)
+    b = Background(sleep, 0.2)
+    assert a.result() is None and b.result() is None
+    assert time() - t0 < 0.35
+    try:
+        Background(int, 'x').result()
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_query_plan():
+    def slow(n):
+        sleep(n)
+        return n
+    def fail(main):
+        raise ValueError
+    plan = QueryPlan(budget=1)
+    plan.add('main', lambda: slow(0.2))
+    plan.add('collections', lambda main: slow(0.2) + main, ['main'])
+    plan.add('alt', lambda main: slow(0.2), ['main'])
+    plan.add('stats', lambda: slow(0.2))
+    plan.add('broken', fail, ['main'])
+    plan.add('after_broken', slow, ['broken'])
+    plan.add('too_slow', lambda main: slow(5), ['main'])
+    plan.run()
+    assert 0.4 <= plan.elapsed < 1.5
+    assert plan.result('collections') == 0.4
+    assert plan.result('alt') == 0.2
+    assert plan.result('stats') == 0.2
+    for name, error in ('broken', ValueError), ('after_broken', QueryTimeout), \
+            ('too_slow', QueryTimeout):
+        try:
+            plan.result(name)
+        except error:
+            pass
+        else:
+            assert False
+    assert plan.timings['collections'][0] >= 0.2
+    assert [name for name, t in plan.timing_breakdown()] == \
+        ['alt', 'broken', 'collections', 'main', 'stats']
@@ -1,76 +1,104 @@
-from flask import Flask, render_template, request, redirect, Response, url_for
-from urllib import urlopen, quote_plus, urlencode
+from flask import Flask, request, redirect, Response, url_for, g, \
+    stream_with_context
+import flask
+from urllib import quote_plus, unquote_plus, urlencode
+import urllib2
 from pprint import pprint, pformat
-import json, locale, sys, re
+import json, locale, sys, re, os, sqlite3, string
 from werkzeug import Headers
 from collections import defaultdict
 
 import MySQLdb
 from subprocess import Popen, PIPE
 
-from socket import socket, AF_INET, SOCK_DGRAM, SOL_UDP, SO_BROADCAST, timeout
-from time import time
+from time import time, sleep
+
+from item_locator import ItemLocator, FindItemError, FakeItemServer
+from parallel import run_parallel, Background, QueryPlan, QueryTimeout
+from export import export_docs, export_formats
+from catalog import CatalogIndex
+from cache import LRUCache, TaggedCache
+from disk_cache import DiskCache
+from solr_client import SolrClient, StubSolrServer, DocStream
+from solr_params import SolrParams, FieldList, encode
+from autocomplete import PrefixIndex
+from field_stats import FieldCounts
+import metrics
+from grid_render import GridRenderer, batches
+from facet_browser import FacetSnapshot
+from facet_planner import plan_facet_params
+from StringIO import StringIO
 
 # Copyright(c)2012 Internet Archive. Software license GPL version 2.
 # Written by Edward Betts <edward@archive.org>
 
 app = Flask(__name__)
 
-re_loc = re.compile('^(ia\d+\.us\.archive\.org):(/\d+/items/(.*))$')
-
-class FindItemError(Exception):
-    pass
+# add a Server-Timing header with the time spent in each stage
+server_timing_header = False
+
+@app.before_request
+def start_request_metrics():
+    g.t0 = time()
+    metrics.metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.count('requests_total', endpoint=endpoint,
+            status=response.status_code)
+    metrics.observe('request_seconds', time() - g.t0, endpoint=endpoint)
+    stages = metrics.metrics.current()
+    if server_timing_header and stages:
+        response.headers['Server-Timing'] = \
+                metrics.metrics.server_timing(stages)
+    return response
+
+def render_template(template_name, **context):
+    with metrics.timer('render', template=template_name):
+        return flask.render_template(template_name, **context)
+
+def stream_template(template_name, **context):
+    # like render_template, but the page is sent as it is generated
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(20)
+    def generate():
+        with metrics.timer('render', template=template_name):
+            for chunk in stream:
+                yield chunk
+    return Response(stream_with_context(generate()))
 
 class SolrError(Exception):
     def __init__(self, value):
         self.value = value
 
-field_counts = {}
+field_counts_path = os.environ.get('FIELD_COUNTS_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'field_counts.jsonl')
+field_counts = FieldCounts(field_counts_path)
 
-def load_field_counts():
-    if field_counts:
-        return
-    f = open('/home/edward/src/ia_solr_frontend/field_counts')
-    for line in f:
-        (count, field, top_collections, top_mediatype) = eval(line)
-        field_counts[field] = count
-    f.close()
+locator = ItemLocator()
 
 def find_item(ia):
-    s = socket(AF_INET, SOCK_DGRAM, SOL_UDP)
-    s.setblocking(1)
-    s.settimeout(2.0)
-    s.setsockopt(1, SO_BROADCAST, 1)
-    s.sendto(ia, ('<broadcast>', 8010))
-    for attempt in range(5):
-        try:
-            (loc, address) = s.recvfrom(1024)
-        except timeout:
-            raise
-        m = re_loc.match(loc)
-        if not m:
-            continue
-
-        ia_host = m.group(1)
-        ia_path = m.group(2)
-        if m.group(3) == ia:
-            return (ia_host, ia_path)
-    raise FindItemError
+    return locator.locate(ia)
 
 db_password = None
 
-def get_catalog_rows():
+def connect_catalog_db():
     global db_password
     if not db_password:
         cmd = Popen(["/opt/.petabox/dbserver"], stdout=PIPE)
         db_password = cmd.communicate()[0]
     assert db_password
-    cur = MySQLdb.connect(host='dbreadonly.us.archive.org', user='archive',
-            passwd=db_password, db='archive').cursor()
-    cur.execute('select identifier, wait_admin from catalog')
-    return cur.fetchall()
+    return MySQLdb.connect(host='dbreadonly.us.archive.org', user='archive',
+            passwd=db_password, db='archive')
+
+catalog_refresh_interval = 300
+catalog = CatalogIndex(connect_catalog_db,
+        refresh_interval=catalog_refresh_interval)
 
-grid_params = set(('field_set', 'fields', 'sort', 'page', 'rows', 'q'))
+grid_params = set(('field_set', 'fields', 'sort', 'page', 'rows', 'q',
+    'output', 'facet_sort', 'prefix'))
 
 facet_fields = ['noindex', 'mediatype', 'collection_facet', 'language_facet',
     'creator_facet', 'subject_facet', 'publisher_facet', 'licenseurl',
@@ -302,9 +330,20 @@ solr_hl = '&hl=true' + \
     '&f.closed_captions.hl.maxAlternateFieldLength=200' + \
     '&hl.fl=title,creator,subject,collection,description,case-name,closed_captions&hl.simple.pre=' + quote('{{{') + '&hl.simple.post=' + quote('}}}')
 
+# Queries shorter than this go to the varnish cache in front of Solr as a
+# GET; longer ones are POSTed straight to Solr, as some proxies refuse very
+# long request lines.
+solr_get_limit = 1024
+
 cache_addr = 'vm-se-test:6081'
 addr = 'vm-se-test:8983'
 
+solr_timeout = 30
+solr = SolrClient(timeout=solr_timeout)
+
+# wall-clock limit for all the Solr queries behind one page
+solr_page_budget = 30
+
 solr_select_url = 'http://' + addr + '/solr/select'
 solr_select_params = 'wt=json' + \
     '&json.nl=arrarr' + \
@@ -315,10 +354,23 @@ solr_select_params = 'wt=json' + \
     '&bq=' + quote('(*:* -collection:ourmedia -collection:opensource* collection:*)^10') + \
     '&q.op=AND'
 
-facet_enum_fields = [ 'noindex', 'language_facet', 'mediatype', 'tv_category',
-    'tv_channel', 'language_facet', 'handwritten', 'scanningcenter' ]
-
-# '&f.' + f + '.facet.method=enum' 
+# used for fields field_counts has no distinct value count for
+facet_enum_fields = set(['noindex', 'language_facet', 'mediatype',
+    'tv_category', 'tv_channel', 'handwritten', 'scanningcenter'])
+
+# facet method per field, worked out from field_counts by the facet
+# planner; redone when the stats file changes
+facet_plans = {}
+def facet_enum_params(fields):
+    stats = field_counts.get()
+    key = (tuple(fields), field_counts.mtime)
+    plan = facet_plans.get(key)
+    if plan is None:
+        if len(facet_plans) > 100:
+            facet_plans.clear()
+        plan = plan_facet_params(fields, stats, facet_enum_fields)
+        facet_plans[key] = plan
+    return plan
 
 facet_params = '&facet=true&facet.limit=20&facet.mincount=1' + \
     '&f.year_from_date.facet.sort=index' + \
@@ -430,6 +482,9 @@ def parse_suggestions(q, suggestions):
     reply = []
     xpos = 0
     for word, s in suggestions:
+        # skip correctlySpelled and collation entries
+        if not isinstance(s, dict) or 'startOffset' not in s:
+            continue
         if s['startOffset'] < xpos:
             continue
         if s['startOffset'] > xpos:
@@ -488,33 +543,70 @@ def test_parse_suggestions():
     expect = [('fix', 'united states')]
     assert parse_suggestions(q, suggestions) == expect
 
+    suggestions.append(['collation', [['collationQuery', 'united states'],
+        ['hits', 42], ['misspellingsAndCorrections', [['stats', 'states']]]]])
+    assert parse_suggestions(q, suggestions) == expect
+    assert parse_collation(suggestions) == ('united states', 42)
+    assert parse_collation([['collation', 'united states']]) == \
+            ('united states', None)
+    assert parse_collation(suggestions[:1]) is None
+
+def parse_collation(suggestions):
+    # (collated query, hits) from spellcheck.collate; hits is None when
+    # Solr didn't send extended results
+    for name, value in suggestions:
+        if name != 'collation':
+            continue
+        if isinstance(value, basestring):
+            return (value, None)
+        if isinstance(value, list):
+            value = dict(value)
+        return (value['collationQuery'], value.get('hits'))
+
 re_thumb_dir_link = re.compile('<a href="(.+\.thumbs/)">')
 re_link = re.compile('<a href="(.+)">')
-def get_movie_thumb(identifier):
-    try:
-        host, path = find_item(identifier)
-    except FindItemError:
-        return
-    try:
-        for line in urlopen('http://' + host + path):
-            m = re_thumb_dir_link.match(line)
-            if m:
-                thumb_dir = m.group(1)
-                break
-        else:
-            return
-    except IOError:
+
+thumb_workers = 10
+thumb_deadline = 5.0
+
+def item_url(host, path):
+    return 'http://' + host + path
+
+def open_item_url(url):
+    return urllib2.urlopen(url, timeout=thumb_deadline)
+
+thumb_cache_path = os.environ.get('THUMB_CACHE_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'thumb_cache.sqlite')
+thumb_cache = DiskCache(thumb_cache_path)
+
+@metrics.timed('thumb_scrape')
+def fetch_movie_thumb(identifier):
+    host, path = find_item(identifier)
+    url = item_url(host, path)
+    for line in open_item_url(url):
+        m = re_thumb_dir_link.match(line)
+        if m:
+            thumb_dir = m.group(1)
+            break
+    else:
         return
     thumbs = []
-    for line in urlopen('http://' + host + path + '/' + thumb_dir):
+    for line in open_item_url(url + '/' + thumb_dir):
         m = re_link.match(line)
         if m:
             thumbs.append(m.group(1))
     return {
-        'url': 'http://' + host + path + '/' + thumb_dir + '/',
+        'url': url + '/' + thumb_dir + '/',
         'imgs': thumbs,
     }
 
+def get_movie_thumb(identifier):
+    try:
+        return thumb_cache.get('movie:' + identifier,
+                lambda: fetch_movie_thumb(identifier))
+    except (FindItemError, IOError):
+        return
+
 re_thumb_link = re.compile('<a href="(.+thumb.*)">')
 
 def add_to_field(field, value):
@@ -560,15 +652,21 @@ def test_changequery():
         params = changequery({'language':None})
         assert params == 'q=test&mediatype=movies'
 
+@metrics.timed('thumb_scrape')
+def fetch_img_thumb(identifier):
+    host, path = find_item(identifier)
+    url = item_url(host, path)
+    for line in open_item_url(url):
+        m = re_thumb_link.match(line)
+        if m:
+            return url + '/' + m.group(1)
+
 def get_img_thumb(identifier):
     try:
-        host, path = find_item(identifier)
-    except FindItemError:
+        return thumb_cache.get('img:' + identifier,
+                lambda: fetch_img_thumb(identifier))
+    except (FindItemError, IOError):
         return
-    for line in urlopen('http://' + host + path):
-        m = re_thumb_link.match(line)
-        if m:
-            return 'http://' + host + path + '/' + m.group(1)
 
 re_date_range = re.compile('^(\d+)-(\d+)$')
 
@@ -592,6 +690,33 @@ def build_pager(num_found, page, pages_in_set = 10, rows=results_per_page):
         'page_list': range(first_page_in_set, last_page_in_set+1),
     }
 
+collection_ttl = 3600
+collection_cache = LRUCache(max_size=20000, ttl=collection_ttl)
+collection_store_path = os.environ.get('COLLECTION_CACHE_PATH')
+collection_store = DiskCache(collection_store_path, fresh_for=collection_ttl) \
+        if collection_store_path else None
+collection_batch_size = 500
+
+def fetch_collections(identifiers):
+    docs = []
+    for i in range(0, len(identifiers), collection_batch_size):
+        cur = identifiers[i:i+collection_batch_size]
+        params = 'wt=json' + \
+            '&json.nl=arrarr' + \
+            '&defType=edismax' + \
+            '&qf=identifier' + \
+            '&q=' + quote(' OR '.join(cur)) + \
+            '&fl=identifier,title,hidden,access-restricted' + \
+            '&rows=%d' % len(cur)
+        with metrics.timer('solr'):
+            reply = solr.fetch(solr_select_url, params, idempotent=True)
+        try:
+            data = json.loads(reply)
+        except ValueError:
+            raise SolrError(reply)
+        docs += data['response']['docs']
+    return docs
+
 def get_collections(results):
     collections = set()
     try:
@@ -604,27 +729,74 @@ def get_collections(results):
 
     if not collections:
         return {}
-    collections = list(collections)
 
+    # cached as False when Solr has no such collection
     docs = []
-    while collections:
-        cur = collections[:50]
-        del collections[:50]
-        url = 'http://' + addr + '/solr/select?wt=json' + \
-            '&json.nl=arrarr' + \
-            '&defType=edismax' + \
-            '&qf=identifier' + \
-            '&q=' + quote(' OR '.join(cur)) + \
-            '&fl=identifier,title,hidden,access-restricted' + \
-            '&rows=%d' % len(cur)
-        reply = urlopen(url).read()
-        try:
-            data = json.loads(reply)
-        except ValueError:
-            raise SolrError(reply)
-        docs += data['response']['docs']
+    missing = []
+    for c in collections:
+        doc = collection_cache.get(c)
+        if doc is None:
+            missing.append(c)
+        elif doc:
+            docs.append(doc)
+
+    if missing and collection_store:
+        not_stored = []
+        for c in missing:
+            try:
+                found = collection_store.lookup(c)
+            except sqlite3.Error:
+                found = None
+            if found and found[1] < collection_ttl:
+                collection_cache.set(c, found[0])
+                if found[0]:
+                    docs.append(found[0])
+            else:
+                not_stored.append(c)
+        missing = not_stored
+
+    if missing:
+        fetched = dict((doc['identifier'], doc)
+                for doc in fetch_collections(missing))
+        for c in missing:
+            doc = fetched.get(c, False)
+            collection_cache.set(c, doc)
+            if collection_store:
+                try:
+                    collection_store.set(c, doc)
+                except sqlite3.Error:
+                    pass
+            if doc:
+                docs.append(doc)
     return docs
 
+def test_get_collections():
+    global solr_select_url
+    def handler(method, path, body):
+        q = dict(i.split('=', 1) for i in body.split('&'))['q']
+        ids = [unquote_plus(i) for i in unquote_plus(q).split(' OR ')]
+        return (200, json.dumps({'response': {'docs': [
+            {'identifier': i, 'title': i.upper()} for i in ids
+                if i != 'nosuch']}}))
+    server = StubSolrServer(handler)
+    saved = solr_select_url
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    collection_cache.clear()
+    try:
+        results = {
+            'facet_counts': {'facet_fields': {'collection_facet':
+                [['movies', 10], ['nosuch', 2]]}},
+            'response': {'docs': [{'collection': ['prelinger', 'movies']}]},
+        }
+        titles = get_collection_titles(results)
+        assert titles == {'movies': 'MOVIES', 'prelinger': 'PRELINGER'}
+        assert get_collection_titles(results) == titles
+        assert len(server.requests) == 1
+    finally:
+        solr_select_url = saved
+        collection_cache.clear()
+        server.close()
+
 def get_collection_titles(results):
     return dict((c['identifier'], c['title'])
             for c in get_collections(results))
@@ -640,49 +812,202 @@ def mlt_page(identifier):
         '&fl=score,*' + \
         '&indent=on' + \
         '&rows=200'
-    ret = urlopen(url).read()
+    with metrics.timer('solr'):
+        ret = solr.fetch(url)
     try:
         data = json.loads(ret)
     except ValueError:
         return ret
-    collection_titles = get_collection_titles(data)
+    collections = get_collections(data)
+    collection_titles = dict((c['identifier'], c['title'])
+            for c in collections)
+    add_hidden_tag(data['response']['docs'],
+            restricted_collections(collections))
+    doc_thumbs = prefetch_thumbs(data['response']['docs'], movies_only=True)
     return render_template('mlt.html', identifier=identifier, mlt=data,
-            get_movie_thumb=get_movie_thumb, pick_best=pick_best,
+            doc_thumbs=doc_thumbs, pick_best=pick_best,
             collection_titles=collection_titles, len=len)
 
+# Solr replies keyed on the decoded, sorted parameters, so the same query
+# hits the cache whatever order the parameters were built in and whether it
+# went out as a GET or a POST. Entries are tagged with the collections they
+# mention so they can be dropped when a collection changes.
+result_cache_ttl = 300
+result_cache_max_entry = 4 * 1024 * 1024
+result_cache = TaggedCache(max_size=256 * 1024 * 1024, ttl=result_cache_ttl,
+        sizeof=len)
+
+re_collection_param = re.compile(r'collection(?:_facet)?:\(?"?([^"()\s]+)')
+re_doc_collections = re.compile(r'"collection"\s*:\s*(\[[^\]]*\])')
+
+def result_cache_key(params):
+    return tuple(sorted(tuple(unquote_plus(i) for i in p.split('=', 1))
+        for p in params.split('&') if p))
+
+def result_cache_tags(key, reply):
+    tags = set()
+    for k, v in key:
+        if k in ('q', 'fq'):
+            tags.update(re_collection_param.findall(v))
+    for m in re_doc_collections.finditer(reply):
+        try:
+            tags.update(json.loads(m.group(1)))
+        except ValueError:
+            pass
+    return tags
+
+def cache_result(key, reply):
+    result_cache.set(key, reply, tags=result_cache_tags(key, reply))
+
+def invalidate_collection(collection):
+    collection_cache.discard(collection)
+    return result_cache.invalidate(collection) + \
+            stats_cache.invalidate(collection)
+
+class RecordingReader(object):
+    # Passes reads through and caches the whole body once it has been read
+    # to the end, unless it grew past result_cache_max_entry.
+
+    def __init__(self, f, key):
+        self.f = f
+        self.key = key
+        self.chunks = []
+        self.size = 0
+
+    def read(self, amt=None):
+        data = self.f.read(amt)
+        if self.chunks is None:
+            return data
+        if data:
+            self.size += len(data)
+            if self.size > result_cache_max_entry:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+        elif amt != 0:
+            cache_result(self.key, ''.join(self.chunks))
+            self.chunks = None
+        return data
+
+# Solr tries collations against the index and reports their hits, so a
+# zero-hit search knows from one request whether a corrected query is
+# worth running
+spellcheck_params = '&spellcheck=true&spellcheck.count=1' + \
+    '&spellcheck.collate=true&spellcheck.maxCollations=1' + \
+    '&spellcheck.maxCollationTries=5&spellcheck.collateExtendedResults=true'
+
 re_all_field = re.compile(r'^([A-Za-z0-9_-]+):\*')
+fl_params = FieldList()
 def search(q, url_params, spellcheck=False, facets=False,
-        rows=results_per_page, fl=fl, debug=False, sort=None):
-    params = solr_select_params + '&q=' + quote(q) + url_params
+        rows=results_per_page, fl=fl, debug=False, sort=None, stream=False,
+        facet_fields=facet_fields):
+    params = SolrParams(solr_select_params, max_get=solr_get_limit)
+    params.add('q', q).add_segment(url_params)
     if facets:
-        params += facet_params
-        params += ''.join('&f.' + f + '.facet.method=enum' for
-                f in facet_enum_fields)
-    params += '&rows=' + str(rows)
-    params += '&fl=' + ','.join(fl)
+        params.add_segment(facet_params)
+        params.add_segment(facet_enum_params(facet_fields))
+    params.add('rows', rows).add_segment(fl_params(fl))
 
     if spellcheck:
-        params += '&spellcheck=true&spellcheck.count=1'
+        params.add_segment(spellcheck_params)
     if q != '*:*' and not re_all_field.match(q):
-        params += solr_hl
+        params.add_segment(solr_hl)
     if debug:
-        params += '&debugQuery=true'
+        params.add_segment('&debugQuery=true')
     if sort:
-        params += '&sort=' + quote(sort)
+        params.add('sort', sort)
+    use_get = params.use_get()
+    params = str(params)
+    url = solr_select_url + '?' + params
     t0_solr = time()
-    if len(params) < 1024:
-        print params
-        f = urlopen('http://' + cache_addr + '/solr/select?' + params)
+    key = None if debug else result_cache_key(params)
+    reply = result_cache.get(key) if key else None
+    cached = reply is not None
+    if cached:
+        f = StringIO(reply)
+        metrics.count('solr_result_cache_hits')
     else:
-        f = urlopen(solr_select_url, params)
-    reply = f.read()
+        with metrics.timer('solr'):
+            if use_get:
+                f = solr.open('http://' + cache_addr + '/solr/select?' +
+                        params)
+            else:
+                f = solr.open(solr_select_url, params, idempotent=True)
+            if not stream:
+                reply = f.read()
+    if stream:
+        if key and not cached:
+            f = RecordingReader(f, key)
+        try:
+            docs = DocStream(f)
+        except ValueError as e:
+            raise SolrError(e.args[0])
+        return {'url': url, 'docs': docs, 't_solr': time() - t0_solr,
+                'cached': cached}
     t_solr = time() - t0_solr
     try:
         results = json.loads(reply)
     except ValueError:
         raise SolrError(reply)
-    url = solr_select_url + '?' + params
-    return {'url': url, 'results': results, 't_solr': t_solr}
+    if key and not cached and len(reply) <= result_cache_max_entry:
+        cache_result(key, reply)
+    return {'url': url, 'results': results, 't_solr': t_solr,
+            'cached': cached}
+
+def test_search_result_cache():
+    global solr_select_url, cache_addr
+    docs = [{'identifier': 'a', 'collection': ['movies', 'prelinger']}]
+    reply = json.dumps({'response': {'numFound': 1, 'start': 0,
+        'docs': docs}})
+    server = StubSolrServer(lambda method, path, body: (200, reply))
+    saved = (solr_select_url, cache_addr)
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    cache_addr = server.addr
+    result_cache.clear()
+    try:
+        first = search('*:*', '&fq=mediatype%3Amovies&fq=year%3A1950')
+        assert not first['cached']
+        again = search('*:*', '&fq=year:1950&fq=mediatype:movies')
+        assert again['cached'] and again['results'] == first['results']
+        long_fq = '&fq=' + quote('identifier:(%s)' % ' '.join(['x'] * 600))
+        search('*:*', long_fq)
+        assert [r[0] for r in server.requests] == ['GET', 'POST']
+        assert search('*:*', long_fq)['cached']
+
+        stream = search('*:*', '&fq=collection:movies', stream=True)
+        assert list(stream['docs']) == docs
+        stream = search('*:*', '&fq=collection:movies', stream=True)
+        assert stream['cached'] and list(stream['docs']) == docs
+        assert len(server.requests) == 3
+
+        assert invalidate_collection('prelinger') == 3
+        assert not search('*:*', '&fq=collection:movies')['cached']
+    finally:
+        (solr_select_url, cache_addr) = saved
+        result_cache.clear()
+        server.close()
+
+# numFound and item_size/downloads stats for a result set, keyed on q and
+# the canonical fq, so paging, sorting and changing rows or columns in /grid
+# reuse them; /collection and the wait_admin catalog grid share the cache.
+stats_params = '&stats=on&stats.field=item_size&stats.field=downloads'
+stats_cache = TaggedCache(max_size=10000, ttl=result_cache_ttl)
+
+def stats_key(q, fq):
+    return result_cache_key('q=' + quote(q) + fq)
+
+def get_result_stats(q, fq):
+    key = stats_key(q, fq)
+    result_stats = stats_cache.get(key)
+    if result_stats is None:
+        results = search(q, fq + stats_params, rows=0,
+                fl=['identifier'])['results']
+        result_stats = {'response':
+                {'numFound': results['response']['numFound']},
+            'stats': results.get('stats')}
+        stats_cache.set(key, result_stats,
+                tags=result_cache_tags(key, ''))
+    return result_stats
 
 re_to_esc = re.compile(r'[\[\]:()]')
 def esc(s):
@@ -698,13 +1023,11 @@ def html_thumbs(identifier):
     return ''.join('<img src="' + thumb['url'] + img + '">'
             for img in thumb['imgs'])
 
-def add_thumbs_to_docs(docs):
+def add_thumbs_to_docs(docs, doc_thumbs):
     max_len = 0
     for doc in docs:
-        if doc['mediatype'] != 'movies':
-            continue
-        thumbs = get_movie_thumb(doc['identifier'])
-        if not thumbs:
+        thumbs = doc_thumbs.get(doc['identifier'])
+        if doc.get('mediatype') != 'movies' or not thumbs:
             continue
         doc['thumbs'] = thumbs
         if len(doc['thumbs']['imgs']) > max_len:
@@ -712,17 +1035,117 @@ def add_thumbs_to_docs(docs):
 
     return max_len
 
+def prefetch_thumbs(docs, movies_only=False):
+    t0 = time()
+    tasks = []
+    keys = {}
+    for doc in docs:
+        identifier = doc['identifier']
+        if doc.get('mediatype') == 'movies':
+            kind, func = 'movie:', get_movie_thumb
+        elif not movies_only and doc.get('mediatype') in ('image', 'software') \
+                and not doc.get('item_filename'):
+            kind, func = 'img:', get_img_thumb
+        else:
+            continue
+        tasks.append((identifier, func, (identifier,)))
+        keys[kind + identifier] = identifier
+    if not tasks:
+        return {}
+    try:
+        cached = thumb_cache.cached_keys(keys)
+    except sqlite3.Error:
+        cached = set()
+    uncached = [identifier for key, identifier in keys.iteritems()
+            if key not in cached]
+    if uncached:
+        locator.locate_many(uncached,
+                timeout=min(locator.timeout, thumb_deadline))
+    return run_parallel(tasks, workers=thumb_workers,
+            timeout=max(thumb_deadline - (time() - t0), 0))
+
+def test_prefetch_thumbs():
+    global locator, thumb_cache, item_url, thumb_deadline
+    listings = {
+        '/1/items/movie1': '<a href="movie1.thumbs/">movie1.thumbs/</a>\n',
+        '/1/items/movie1/movie1.thumbs/':
+            '<a href="movie1_000001.jpg">movie1_000001.jpg</a>\n' +
+            '<a href="movie1_000002.jpg">movie1_000002.jpg</a>\n',
+        '/1/items/image1': '<a href="image1_thumb.jpg">image1_thumb.jpg</a>\n',
+        '/1/items/slow': '<a href="slow.thumbs/">slow.thumbs/</a>\n',
+    }
+    def handler(method, path, body):
+        if path.startswith('/1/items/slow'):
+            sleep(1.5)
+        return (200, listings.get(path, ''))
+    web = StubSolrServer(handler)
+    items = FakeItemServer(dict((ia, ('ia600100.us.archive.org',
+        '/1/items/' + ia)) for ia in ('movie1', 'image1', 'slow')))
+    saved = (locator, thumb_cache, item_url, thumb_deadline)
+    locator = ItemLocator(addr=items.addr, timeout=0.3)
+    thumb_cache = DiskCache(':memory:')
+    item_url = lambda host, path: 'http://' + web.addr + path
+    thumb_deadline = 0.8
+    try:
+        docs = [
+            {'identifier': 'movie1', 'mediatype': 'movies'},
+            {'identifier': 'image1', 'mediatype': 'image'},
+            {'identifier': 'image2', 'mediatype': 'image',
+                'item_filename': ['image2_thumb.jpg']},
+            {'identifier': 'slow', 'mediatype': 'movies'},
+            {'identifier': 'text1', 'mediatype': 'texts'},
+        ]
+        t0 = time()
+        found = prefetch_thumbs(docs)
+        assert time() - t0 < 1.2
+        assert found['movie1']['imgs'] == \
+                ['movie1_000001.jpg', 'movie1_000002.jpg']
+        assert found['image1'] == \
+                'http://' + web.addr + '/1/items/image1/image1_thumb.jpg'
+        assert not found.get('slow')
+        assert set(found) <= set(['movie1', 'image1', 'slow'])
+
+        assert set(prefetch_thumbs(docs, movies_only=True)) <= \
+                set(['movie1', 'slow'])
+    finally:
+        locator.close()
+        (locator, thumb_cache, item_url, thumb_deadline) = saved
+        items.close()
+        web.close()
+
+collection_list_path = os.environ.get('COLLECTION_LIST_PATH') or \
+        '/home/edward/src/ia_solr_frontend/collections'
+collection_index = PrefixIndex(collection_list_path)
+
+# rank suggestions by number of items, from the collection_facet counts
+autocomplete_by_size = False
+collection_sizes = LRUCache(max_size=1, ttl=3600)
+collection_sizes_loading = []
+
+def load_collection_sizes():
+    try:
+        results = search('*:*', '&facet=true&facet.field=collection_facet'
+                '&facet.limit=-1&facet.mincount=1&facet.method=enum', rows=0)
+        counts = results['results']['facet_counts']['facet_fields']
+        collection_sizes.set('sizes', dict(counts['collection_facet']))
+    finally:
+        del collection_sizes_loading[:]
+
+def get_collection_sizes():
+    # stale or missing sizes are reloaded in the background; until then
+    # suggestions come back in plain order
+    sizes = collection_sizes.get('sizes')
+    if sizes is None and not collection_sizes_loading:
+        collection_sizes_loading.append(Background(load_collection_sizes))
+    return sizes
+
 @app.route("/collection_autocomplete")
 def collection_autocomplete():
     if 'term' not in request.args:
         return '[]'
-    term = request.args['term'].lower()
-    found = []
-    for line in open('/home/edward/src/ia_solr_frontend/collections'):
-        if line.lower().startswith(term):
-            found.append(line[:-1])
-        elif found:
-            break
+    rank = get_collection_sizes() if autocomplete_by_size else None
+    found = collection_index.complete(request.args['term'].encode('utf-8'),
+            rank=rank)
     return Response(json.dumps(found), mimetype='application/json')
 
 re_long_repeating_phrase = re.compile('(.{6}){4,}')
@@ -780,57 +1203,106 @@ def grid_field(f):
         assert m.group(1) == '>'
         return (f, '[' + m.group(2) + ' TO *]')
 
-def add_hidden_tag(docs, collections):
+def restricted_collections(collection_docs):
+    return set(c['identifier'] for c in collection_docs
+            if c.get('access-restricted', [None])[0] == 'true')
+
+def add_hidden_tag(docs, restricted):
+    # restricted is the set from restricted_collections()
+    if not restricted:
+        return
     for doc in docs:
-        if 'collection' not in doc:
-            continue
-        k = 'access-restricted'
-        if any(k in collections.get(c, {}) and collections[c][k][0] == 'true'
-                for c in doc['collection']):
-            doc[k] = 'true'
+        if not restricted.isdisjoint(doc.get('collection', ())):
+            doc['access-restricted'] = 'true'
+
+def test_add_hidden_tag():
+    restricted = restricted_collections([
+        {'identifier': 'a', 'access-restricted': ['true']},
+        {'identifier': 'b', 'access-restricted': ['false']},
+        {'identifier': 'c'}])
+    assert restricted == set(['a'])
+    docs = [{'collection': ['b', 'a']}, {'collection': ['c']}, {}]
+    add_hidden_tag(docs, restricted)
+    assert [d.get('access-restricted') for d in docs] == ['true', None, None]
 
 @app.route("/collection/<collection>")
 def collection_page(collection):
 
-    t0 = time()
-    url = 'http://' + addr + '/solr/select?wt=json' + \
+    def fetch_json(url):
+        with metrics.timer('solr'):
+            ret = solr.fetch(url)
+        try:
+            return json.loads(ret)
+        except ValueError:
+            raise SolrError(ret)
+
+    title_url = 'http://' + addr + '/solr/select?wt=json' + \
         '&json.nl=arrarr' + \
         '&defType=edismax' + \
         '&qf=identifier' + \
         '&q=' + quote(collection) + \
         '&fl=identifier,title,hidden,access-restricted' + \
         '&rows=1'
-    ret = urlopen(url).read()
-    try:
-        data = json.loads(ret)
-    except ValueError:
-        return ret
-    title = data['response']['docs'][0]['title']
 
-    url = 'http://' + addr + '/solr/select?wt=json' + \
-        '&json.nl=arrarr' + \
-        '&q=collection:' + quote(collection) + \
-        '&fl=identifier' + \
-        '&indent=on' + \
-        '&stats=on' + \
-        '&stats.field=item_size' + \
-        '&stats.field=downloads' + \
-        '&rows=0'
-    ret = urlopen(url).read()
+    fq = parse_search_fields([('collection', collection)])
+
+    plan = QueryPlan(budget=solr_page_budget)
+    plan.add('title', lambda: fetch_json(title_url))
+    plan.add('stats', lambda: get_result_stats('*:*', fq))
+    plan.run()
     try:
-        data = json.loads(ret)
-    except ValueError:
-        return ret
-    t_solr = time() - t0
+        title = plan.result('title')['response']['docs'][0]['title']
+        data = plan.result('stats')
+    except SolrError as solr_error:
+        return solr_error.value
+    t_solr = plan.elapsed
 
     #return Response(pformat(data['stats']['stats_fields']), mimetype='text/plain')
     return render_template('collection.html', collection=collection,
             title=title, comma=comma, fmt_filesize=fmt_filesize, results=data,
-            t_solr=t_solr)
+            t_solr=t_solr, solr_timings=plan.timing_breakdown())
+
+@app.route("/metrics")
+def metrics_page():
+    return Response(metrics.metrics.render(), mimetype='text/plain')
+
+def test_metrics_page():
+    global server_timing_header
+    server_timing_header = True
+    try:
+        client = app.test_client()
+        r = client.get('/fields')
+        assert r.headers['Server-Timing'].startswith('render;dur=')
+    finally:
+        server_timing_header = False
+    text = client.get('/metrics').data
+    assert 'requests_total{endpoint="select_fields_page",status="200"}' in text
+    assert 'stage_seconds_count{stage="render",template="select_fields.html"}' \
+            in text
+
+@app.route("/stats")
+def stats_page():
+    stats = {
+        'solr': solr.stats(),
+        'item_locations': locator.cache.stats(),
+        'wait_admin_fq': wait_admin_fq_cache.stats(),
+        'collections': collection_cache.stats(),
+        'results': result_cache.stats(),
+        'facets': facet_cache.stats(),
+        'result_stats': stats_cache.stats(),
+        'thumb_paths': thumb_path_cache.stats(),
+        'thumbs': thumb_cache.stats(),
+    }
+    return Response(json.dumps(stats, indent=2), mimetype='application/json')
+
+@app.route("/invalidate/collection/<collection>", methods=['POST'])
+def invalidate_collection_page(collection):
+    dropped = invalidate_collection(collection)
+    return Response(json.dumps({'collection': collection, 'dropped': dropped}),
+            mimetype='application/json')
 
 @app.route("/fields")
 def select_fields_page():
-    load_field_counts()
     other = set()
     for k, v in field_set.iteritems():
         if k in ('all', 'default', 'software',):
@@ -844,7 +1316,7 @@ def select_fields_page():
         set=set,
         comma=comma,
         field_set=field_set,
-        field_counts=field_counts,
+        field_counts=field_counts.get(),
         not_in_other=not_in_other,
         all_fields=field_set['all'],
         field_count=len(other | set(field_set['all'])),
@@ -855,23 +1327,84 @@ def test_args():
     with app.test_request_context('/'):
         request.args
 
-def parse_search_fields(search_fields, all_catalog_rows):
+# Solr 4.10+ can take the whole set as one {!terms} query, which skips the
+# boolean clause limit entirely.
+solr_terms_query = False
+fq_chunk_size = 500
+
+def identifier_fq(identifiers):
+    if solr_terms_query:
+        return '{!terms f=identifier}' + ','.join(identifiers)
+    return '{!lucene q.op=OR} ' + ' '.join('identifier:(' +
+            ' '.join(identifiers[i:i+fq_chunk_size]) + ')'
+        for i in range(0, len(identifiers), fq_chunk_size))
+
+def test_identifier_fq():
+    global fq_chunk_size, solr_terms_query
+    saved = (fq_chunk_size, solr_terms_query)
+    fq_chunk_size = 2
+    try:
+        assert identifier_fq(['a', 'b', 'c']) == \
+                '{!lucene q.op=OR} identifier:(a b) identifier:(c)'
+        solr_terms_query = True
+        assert identifier_fq(['a', 'b', 'c']) == '{!terms f=identifier}a,b,c'
+    finally:
+        (fq_chunk_size, solr_terms_query) = saved
+
+# keyed on the catalog snapshot, so the same admin queue gives the same fq
+# string (and hits Solr's filterCache) until the catalog changes
+wait_admin_fq_cache = LRUCache(max_size=32)
+
+def parse_search_fields(search_fields):
     def fq_wait_admin(num):
-        if num == '*':
-            catalog_rows = [identifier for identifier, wait_admin
-                in all_catalog_rows]
-        else:
-            catalog_rows = [identifier for identifier, wait_admin 
-                in all_catalog_rows if wait_admin==int(num)]
-
-        if catalog_rows:
-            return '&fq={!lucene q.op=OR} identifier:(' + ' '.join(catalog_rows) + ')'
-        else:
+        catalog_rows = catalog.identifiers(num)
+        if not catalog_rows:
             return ''
+        key = (num, catalog.version)
+        fq = wait_admin_fq_cache.get(key)
+        if fq is None:
+            fq = '&fq=' + quote(identifier_fq(catalog_rows))
+            wait_admin_fq_cache.set(key, fq)
+        return fq
 
     print search_fields
     return ''.join(('&fq=' + quote('%s:(%s)' % i)) if i[0] != 'wait_admin' else fq_wait_admin(i[1]) for i in search_fields)
 
+facet_page_size = 100
+
+# Full value lists for /facet pages, keyed on field and filters. Fields with
+# more than facet_snapshot_max values are marked False and always paged by
+# Solr instead.
+facet_snapshot_max = 200000
+facet_snapshots = LRUCache(max_size=2000000, ttl=600,
+        sizeof=lambda snapshot: len(snapshot) if snapshot else 1)
+facet_snapshots_loading = set()
+
+def load_facet_snapshot(key, facet_field, fq):
+    try:
+        url_params = fq + '&facet=true&facet.mincount=1&facet.sort=count' + \
+            '&facet.limit=%d' % (facet_snapshot_max + 1) + \
+            '&facet.field=' + facet_field + facet_enum_params([facet_field])
+        results = search('*:*', url_params, rows=0)['results']
+        counts = results['facet_counts']['facet_fields'][facet_field]
+        if len(counts) > facet_snapshot_max:
+            facet_snapshots.set(key, False)
+        else:
+            facet_snapshots.set(key, FacetSnapshot(counts,
+                results['response']['numFound']))
+    finally:
+        facet_snapshots_loading.discard(key)
+
+def get_facet_snapshot(facet_field, fq):
+    # the snapshot if there is one; otherwise starts building it in the
+    # background and returns None
+    key = (facet_field,) + result_cache_key(fq)
+    snapshot = facet_snapshots.get(key)
+    if snapshot is None and key not in facet_snapshots_loading:
+        facet_snapshots_loading.add(key)
+        Background(load_facet_snapshot, key, facet_field, fq)
+    return snapshot
+
 @app.route("/facet/<field>")
 def facet_page(field):
     field = field.lower()
@@ -881,29 +1414,102 @@ def facet_page(field):
         facet_field = field + '_facet'
     else:
         return render_template('facet.html', field=field, changequery=changequery)
-    rows = 0
     #search_fields = [grid_field(f) for f in all_fields if request.args.get(f)]
     search_fields = [grid_field(f)
             for f in request.args.iterkeys() if f not in grid_params]
-    all_catalog_rows = get_catalog_rows() if request.args.get('wait_admin') else None
-    fq = parse_search_fields(search_fields, all_catalog_rows)
+    fq = parse_search_fields(search_fields)
 
-    q = '*:*'
-    url_params = fq
-    url_params += '&facet=true&facet.mincount=1&facet.limit=-1&facet.sort=count' 
-    url_params += '&facet.field=' + facet_field
-    url_params += ''.join('&f.' + f + '.facet.method=enum'
-            for f in facet_enum_fields)
+    page = int(request.args.get('page', 1))
+    offset = facet_page_size * (page - 1)
+    facet_sort = 'index' if request.args.get('facet_sort') == 'index' \
+            else 'count'
+    prefix = request.args.get('prefix') or None
 
-    search_results = search(q, url_params, rows=rows)
-    results = search_results['results']
-    return render_template('facet.html', field=field,
-        counts=results['facet_counts']['facet_fields'][facet_field],
-        total=results['response']['numFound'], comma=comma,
-        t_solr=search_results['t_solr'], changequery=changequery,
-        add_to_field=add_to_field, solr_esc=esc, search_fields=search_fields
+    t0 = time()
+    snapshot = get_facet_snapshot(facet_field, fq)
+    if snapshot:
+        counts, num_values = snapshot.page(offset, facet_page_size,
+                facet_sort, prefix)
+        total = snapshot.total
+        initials = snapshot.initials()
+        has_next = offset + facet_page_size < num_values
+    else:
+        q = '*:*'
+        url_params = fq
+        url_params += '&facet=true&facet.mincount=1'
+        url_params += '&facet.sort=' + facet_sort
+        url_params += '&facet.offset=%d' % offset
+        url_params += '&facet.limit=%d' % (facet_page_size + 1)
+        if prefix:
+            url_params += '&facet.prefix=' + quote(prefix)
+        url_params += '&facet.field=' + facet_field
+        url_params += facet_enum_params([facet_field])
+        try:
+            results = search(q, url_params, rows=0)['results']
+        except SolrError as solr_error:
+            return solr_error.value
+        counts = results['facet_counts']['facet_fields'][facet_field]
+        has_next = len(counts) > facet_page_size
+        counts = counts[:facet_page_size]
+        total = results['response']['numFound']
+        num_values = None
+        initials = list(string.ascii_uppercase + string.ascii_lowercase)
+    t_solr = time() - t0
+
+    pager = build_pager(num_values, page, rows=facet_page_size) \
+            if num_values else None
+    return stream_template('facet.html', field=field,
+        counts=iter(counts), total=total, num_values=num_values, comma=comma,
+        t_solr=t_solr, changequery=changequery, page=page, pager=pager,
+        has_next=has_next, facet_sort=facet_sort, prefix=prefix,
+        initials=initials, add_to_field=add_to_field, solr_esc=esc,
+        search_fields=search_fields
     )
 
+def test_facet_page():
+    global solr_select_url, cache_addr
+    values = [['value%03d' % i, 1000 - i] for i in range(250)]
+    def handler(method, path, body):
+        params = dict(i.split('=', 1) for i in path.split('?', 1)[1].split('&'))
+        offset = int(params.get('facet.offset', 0))
+        limit = int(params['facet.limit'])
+        sleep(0.2 if 'facet.offset' not in params else 0)
+        return (200, json.dumps({'response': {'numFound': 5000, 'docs': []},
+            'facet_counts': {'facet_fields': {'collection_facet':
+                values[offset:offset + limit]}}}))
+    server = StubSolrServer(handler)
+    saved = (solr_select_url, cache_addr)
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    cache_addr = server.addr
+    result_cache.clear()
+    facet_snapshots.clear()
+    try:
+        client = app.test_client()
+        page = ''.join(client.get('/facet/collection?page=2').response)
+        assert 'value100' in page and 'value199' in page
+        assert 'value200' not in page
+        for attempt in range(50):
+            if not facet_snapshots_loading:
+                break
+            sleep(0.05)
+        requests = len(server.requests)
+        page = ''.join(client.get('/facet/collection?page=3').response)
+        assert 'value249' in page and '250 unique values' in page
+        page = ''.join(client.get('/facet/collection?facet_sort=index'
+            '&prefix=value01').response)
+        assert 'value010' in page and 'value020' not in page
+        assert len(server.requests) == requests
+    finally:
+        (solr_select_url, cache_addr) = saved
+        result_cache.clear()
+        facet_snapshots.clear()
+        server.close()
+
+export_rows = 1000
+
+# docs tagged and rendered together in a streamed /grid page
+grid_batch_size = 500
+
 @app.route("/identifier_list")
 def identifier_list():
     search_fields = [grid_field(f) 
@@ -911,56 +1517,89 @@ def identifier_list():
     fq = ''.join('&fq=' + quote('%s:(%s)' % i)
             for i in search_fields)
     q = '*:*'
-    url_params = fq
-
-    def get_results():
-        rows = 1000
-        ret = search(q, url_params, rows=rows, fl=['identifier'])
-        num = ret['results']['response']['numFound']
-        for doc in ret['results']['response']['docs']:
-            yield doc['identifier'].encode('utf-8') + '\r\n'
-        for start in range(rows, num, rows):
-            ret = search(q, url_params, rows=rows, fl=['identifier'])
-            for doc in ret['results']['response']['docs']:
-                yield doc['identifier'].encode('utf-8') + '\r\n'
+
+    if request.args.get('fields') or request.args.get('field_set'):
+        fields = ['identifier'] + [f for f in selected_fields()
+                if f != 'identifier']
+    else:
+        fields = ['identifier']
+    output = request.args.get('output', 'txt')
+    if output not in export_formats:
+        output = 'txt'
+    write, mimetype, ext = export_formats[output]
+
+    # deep paging with start= gets slower the further in it goes, so page
+    # by identifier instead: each page asks for identifiers after the last
+    # one seen
+    def fetch_page(after):
+        url_params = fq
+        if after is not None:
+            url_params += '&fq=' + quote('identifier:{"%s" TO *]' % after)
+        return list(search(q, url_params, rows=export_rows, fl=fields,
+                sort='identifier asc', stream=True)['docs'])
 
     headers = Headers()
-    headers.add("Content-Type", 'text/plain; charset=utf-8')
-    headers.add("Content-Disposition", "attachment; filename=results.txt")
-    return Response(get_results(), headers=headers, direct_passthrough=True)
+    headers.add("Content-Type", mimetype)
+    headers.add("Content-Disposition", "attachment; filename=results." + ext)
+    return Response(write(export_docs(fetch_page, export_rows), fields),
+            headers=headers, direct_passthrough=True)
+
+re_thumb_suffix = re.compile(r'(logo)?\.(?:(jpe?g|png)|gif)$', re.I)
+
+# identifier -> chosen thumb_path ('' for none)
+thumb_path_cache = LRUCache(max_size=100000, ttl=3600)
+
+def pick_thumb_path(filenames):
+    # a *thumb.jpg wins outright; otherwise the first logo, then the first
+    # jpg/png, then the first gif
+    first_img = first_logo = first_gif = None
+    for filename in filenames:
+        if filename.endswith('thumb.jpg'):
+            return filename
+        m = re_thumb_suffix.search(filename)
+        if not m:
+            continue
+        if not m.group(2):
+            first_gif = first_gif or filename
+            continue
+        first_img = first_img or filename
+        if m.group(1):
+            first_logo = first_logo or filename
+    return first_logo or first_img or first_gif
 
 def add_thumb_path(docs):
     for doc in docs:
+        identifier = doc['identifier']
         if doc.get('mediatype') == 'texts' and doc.get('scanner'):
-            doc['thumb_path'] = '/page/{{doc.identifier}}_cover_h80.jpg'
-        else:
-            first_img = None
-            first_logo = None
-            first_gif = None
-            for filename in doc.get('item_filename', []):
-                if filename.endswith('thumb.jpg'):
-                    doc['thumb_path'] = filename
-                    break
-                lc_filename = filename.lower()
-                if not first_img and any(lc_filename.endswith('.' + ext) for ext in ('jpg', 'jpeg', 'png')):
-                    first_img = filename
-                if not first_logo and any(lc_filename.endswith('logo.' + ext) for ext in ('jpg', 'jpeg', 'png')):
-                    first_logo = filename
-                if not first_gif and lc_filename.endswith('.gif'):
-                    first_gif = filename
-            if not doc.get('thumb_path'):
-                if first_logo:
-                    doc['thumb_path'] = first_logo
-                elif first_img:
-                    doc['thumb_path'] = first_img
-                elif first_gif:
-                    doc['thumb_path'] = first_gif
-
+            doc['thumb_path'] = 'page/%s_cover_h80.jpg' % identifier
+            continue
+        thumb_path = thumb_path_cache.get(identifier)
+        if thumb_path is None:
+            thumb_path = pick_thumb_path(doc.get('item_filename', [])) or ''
+            thumb_path_cache.set(identifier, thumb_path)
+        if thumb_path:
+            doc['thumb_path'] = thumb_path
+
+def test_add_thumb_path():
+    thumb_path_cache.clear()
+    docs = [
+        {'identifier': 'a', 'item_filename': ['a.GIF', 'a.png', 'x_logo.JPG',
+            'a_thumb.jpg', 'b.jpg']},
+        {'identifier': 'b', 'item_filename': ['b.gif', 'b.Jpeg', 'logo.png']},
+        {'identifier': 'c', 'item_filename': ['c.gif', 'c.mp3']},
+        {'identifier': 'd', 'item_filename': ['d.txt']},
+        {'identifier': 'e', 'mediatype': 'texts', 'scanner': 'x'},
+    ]
+    add_thumb_path(docs)
+    assert [d.get('thumb_path') for d in docs] == ['a_thumb.jpg', 'logo.png',
+        'c.gif', None, 'page/e_cover_h80.jpg']
+    again = [{'identifier': 'b'}]
+    add_thumb_path(again)
+    assert again[0]['thumb_path'] == 'logo.png'
+    thumb_path_cache.clear()
 
 def catalog_page(selected_wait_admin):
-    all_catalog_rows = get_catalog_rows()
-    catalog_rows = [identifier for identifier, wait_admin 
-            in all_catalog_rows if wait_admin==selected_wait_admin]
+    catalog_rows = catalog.identifiers(selected_wait_admin)
 
     fields = selected_fields()
     rows = int(request.args.get('rows', 100))
@@ -982,25 +1621,28 @@ def catalog_page(selected_wait_admin):
             ('start', str(start)),
             ('rows', str(rows)),
             ('fl', ','.join(cur_fields)),
-            ('stats', 'on'),
-            ('stats.field', 'item_size'),
-            ('stats.field', 'downloads'),
             ('q.op', 'AND'),
             ('q', '*:*'),
-            ('fq', '{!lucene q.op=OR} identifier:(' + ' '.join(catalog_rows) + ')')]
+            ('fq', identifier_fq(catalog_rows))]
 
         sort = request.args.get('sort')
         if sort:
             params += ('sort', sort)
 
-        f = urlopen(url, urlencode(params))
         t0 = time()
-        reply = f.read()
-        t_solr = time() - t0
+        stats_query = Background(get_result_stats, '*:*',
+                '&fq=' + quote(identifier_fq(catalog_rows)))
+        with metrics.timer('solr'):
+            reply = solr.fetch(url, urlencode(params), idempotent=True)
         try:
             results = json.loads(reply)
         except:
             return reply
+        try:
+            results['stats'] = stats_query.result()['stats']
+        except SolrError as solr_error:
+            return solr_error.value
+        t_solr = time() - t0
 
         add_thumb_path(results['response']['docs'])
 
@@ -1010,15 +1652,19 @@ def catalog_page(selected_wait_admin):
         results = None
         t_solr = None
 
+    docs = results['response']['docs'] if results else []
+    renderer = GridRenderer(fields, request.args, changequery, quote, esc,
+            comma, fmt_filesize, single_value_fields, app.jinja_env)
+    catalog_rows = catalog.states([doc['identifier'] for doc in docs])
+    doc_rows = [renderer.row(doc, i + 1, catalog_rows)
+            for i, doc in enumerate(docs)]
     return render_template('grid.html', changequery=changequery,
         field_set=field_set, zap_field=zap_field, page=page, fields=fields,
         results=results, results_per_page=rows, pager=pager, t_solr=t_solr,
-        quote=quote, comma=comma, len=len, list_fields=list_fields, 
-        facet_fields=facet_fields,
-        catalog_rows=dict(all_catalog_rows),
-        single_value_fields=single_value_fields, int=int,
-        solr_esc=esc, isinstance=isinstance, basestring=basestring, rows=rows,
-        fmt_filesize=fmt_filesize, search_fields=[], search_query='red rows')
+        doc_rows=doc_rows, comma=comma, facet_fields=facet_fields,
+        single_value_fields=single_value_fields, fmt_filesize=fmt_filesize,
+        rows=rows, search_fields=[],
+        search_query='red rows')
 
 @app.route("/grid")
 def grid_page():
@@ -1049,19 +1695,11 @@ def grid_page():
     if not search_fields and not request.args.get('q'):
         return render_template('grid.html', changequery=changequery,
             field_set=field_set, zap_field=zap_field, page=page, fields=fields,
-            results=[], results_per_page=rows, 
-            quote=quote, comma=comma, len=len, 
-            list_fields=list_fields, 
-            single_value_fields=single_value_fields, int=int,
-            solr_esc=esc, isinstance=isinstance, basestring=basestring, rows=rows,
+            results=[], results_per_page=rows, doc_rows=[], comma=comma,
+            single_value_fields=single_value_fields, rows=rows,
             fmt_filesize=fmt_filesize)
 
-    all_catalog_rows = get_catalog_rows()
-    fq = parse_search_fields(search_fields, all_catalog_rows)
-
-    catalog_rows = defaultdict(set)
-    for k, v in all_catalog_rows:
-        catalog_rows[k].add(v)
+    fq = parse_search_fields(search_fields)
 
     search_query = ', '.join(k + '=' + v for k, v in search_fields)
 
@@ -1070,8 +1708,6 @@ def grid_page():
     #url_params += ''.join('&facet.field=' + f for f in grid_facet_fields)
     #url_params += ''.join('&f.' + f + '.facet.method=enum' for f in facet_enum_fields)
 
-    url_params += '&stats=on&stats.field=item_size&stats.field=downloads'
-
     cur_fields = list(selected_fields())
     for f in 'collection', 'noindex', 'scanner', 'item_filename':
         if f not in cur_fields:
@@ -1079,31 +1715,202 @@ def grid_page():
 
     debug = request.args.get('debug')
     sort = request.args.get('sort')
+    t0_solr = time()
+    # Solr puts stats after the docs, but the page shows them above the
+    # table, so on a cache miss they come from their own rows=0 query
+    result_stats = stats_cache.get(stats_key(q, fq))
+    stats_query = None
+    if result_stats is None:
+        stats_query = Background(get_result_stats, q, fq)
     try:
         search_results = search(q, url_params, rows=rows, \
-            fl=cur_fields, debug=debug, sort=sort)
+            fl=cur_fields, debug=debug, sort=sort, stream=True)
+        if stats_query:
+            result_stats = stats_query.result()
     except SolrError as solr_error:
         return solr_error.value
+    t_solr = time() - t0_solr
 
-    results = search_results['results']
-    collections = dict((c['identifier'], c) for c in get_collections(results))
+    docs = search_results['docs']
+    results = {'response': {'numFound': docs.num_found},
+        'stats': result_stats['stats']}
+    pager = build_pager(docs.num_found, page, rows=rows)
+    renderer = GridRenderer(fields, request.args, changequery, quote, esc,
+            comma, fmt_filesize, single_value_fields, app.jinja_env)
+
+    # Docs are decoded, tagged and rendered a batch at a time as the Solr
+    # reply arrives, so memory doesn't grow with rows. item_filename is
+    # only fetched to pick a thumbnail and is dropped unless displayed.
+    def doc_rows():
+        index = 0
+        for batch in batches(docs, grid_batch_size):
+            add_thumb_path(batch)
+            if 'item_filename' not in fields:
+                for doc in batch:
+                    doc.pop('item_filename', None)
+            add_hidden_tag(batch, restricted_collections(
+                get_collections({'response': {'docs': batch}})))
+            catalog_rows = catalog.states([doc['identifier'] for doc in batch])
+            for doc in batch:
+                index += 1
+                yield renderer.row(doc, index, catalog_rows)
+
+    return stream_template('grid.html', changequery=changequery,
+        field_set=field_set, zap_field=zap_field, page=page, fields=fields,
+        results=results, results_per_page=rows, pager=pager, t_solr=t_solr,
+        doc_rows=doc_rows(), comma=comma, facet_fields=facet_fields,
+        single_value_fields=single_value_fields, fmt_filesize=fmt_filesize,
+        rows=rows, search_fields=search_fields,
+        search_query=search_query)
+
+def test_result_stats():
+    global solr_select_url, cache_addr, addr, catalog
+    from catalog import sqlite_catalog
+    def handler(method, path, body):
+        params = path.split('?', 1)[1] if '?' in path else body
+        reply = {'response': {'numFound': 300, 'start': 0, 'docs':
+            [{'identifier': 'americana', 'title': 'American Libraries'}]}}
+        if 'stats=on' in params:
+            reply['response']['docs'] = []
+            reply['stats'] = {'stats_fields': {'item_size': {'sum': 2048,
+                'count': 300, 'max': 100, 'mean': 7},
+                'downloads': {'sum': 12345, 'max': 99}}}
+        return (200, json.dumps(reply))
+    server = StubSolrServer(handler)
+    saved = (solr_select_url, cache_addr, addr, catalog)
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    cache_addr = addr = server.addr
+    db = sqlite_catalog([])
+    catalog = CatalogIndex(lambda: db)
+    result_cache.clear()
+    stats_cache.clear()
+    try:
+        client = app.test_client()
+        for url in ('/grid?collection=americana',
+                '/grid?collection=americana&page=2',
+                '/grid?collection=americana&rows=50&sort=downloads+desc',
+                '/collection/americana'):
+            page = ''.join(client.get(url).response)
+            assert '12,345' in page or '12345' in page
+        stats_requests = [r for r in server.requests
+                if 'stats=on' in r[1] + (r[2] or '')]
+        assert len(stats_requests) == 1
+        assert invalidate_collection('americana') >= 1
+        assert len(stats_cache) == 0
+    finally:
+        (solr_select_url, cache_addr, addr, catalog) = saved
+        result_cache.clear()
+        stats_cache.clear()
+        server.close()
+
+def search_filters(args):
+    # (fq, facet.field params) for the filters in a search URL
+    facet_args_dict = dict((f, args[f]) for f in facet_fields if args.get(f))
+    #fq = ''.join('&fq=' + quote('{!tag=%s}{!term f=%s}%s' % (f, f, args[f])) for f in facet_fields if f in args)
+    fq = ''.join('&fq=' + quote('{!tag=%s}%s:"%s"' % (f, f, esc(args[f]))) for f in facet_fields if args.get(f))
+    date_range = args.get('date_range')
+    date_facet = args.get('date_facet')
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+    if date_range:
+        m = re_date_range.match(date_range)
+        if m:
+            start_year, end_year = m.groups()
+            fq += '&fq=' + quote('date:[%s-01-01T00:00:00Z TO %s-01-01T00:00:00Z]' % (start_year, end_year))
+    elif date_facet:
+        fq += '&fq=' + quote('date:([%s-01-01T00:00:00Z TO %s-01-01T00:00:00Z+%dYEAR] NOT "%s-01-01T00:00:00Z+%dYEAR")' % (date_facet, date_facet, year_gap, date_facet, year_gap))
+    elif date_from and date_to:
+        fq += '&fq=' + quote('date:[%sT00:00:00Z TO %sT00:00:00Z]' % (date_from, date_to))
 
-    add_hidden_tag(results['response']['docs'], collections)
-    t_solr = search_results['t_solr']
-    url = search_results['url']
-    pager = build_pager(results['response']['numFound'], page, rows=rows)
+    url_facet_fields = encode(('facet.field', ('{!ex=' + f + '}' if f in facet_args_dict else '') + f) for f in facet_fields)
+    return fq, url_facet_fields
+
+def reverse_index_facets(facet_counts):
+    for f in 'tv_original_year', 'year_from_date':
+        try:
+            facet_counts['facet_fields'][f].reverse()
+        except KeyError:
+            pass
 
-    add_thumb_path(results['response']['docs'])
+# With split_facets the search page asks Solr for hits and highlighting
+# only, and the sidebar is filled in from /facets, which has its own cache
+# keyed on q and the filters, so paging and view changes reuse it.
+split_facets = True
+facet_cache = LRUCache(max_size=5000, ttl=result_cache_ttl)
 
-    return render_template('grid.html', changequery=changequery,
-        field_set=field_set, zap_field=zap_field, page=page, fields=fields,
-        results=results, results_per_page=rows, pager=pager, t_solr=t_solr,
-        quote=quote, comma=comma, len=len, list_fields=list_fields, 
-        catalog_rows=catalog_rows, list=list,
-        facet_fields=facet_fields, str=str,
-        single_value_fields=single_value_fields, int=int,
-        solr_esc=esc, isinstance=isinstance, basestring=basestring, rows=rows,
-        fmt_filesize=fmt_filesize, search_fields=search_fields, search_query=search_query)
+# collated query for searches that found nothing, keyed on q and fq
+zero_hit_collations = LRUCache(max_size=10000, ttl=3600)
+
+@app.route("/facets")
+def facets_page():
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return Response(json.dumps({'error': 'no q'}), status=400,
+                mimetype='application/json')
+    fq, url_facet_fields = search_filters(request.args)
+    key = (q,) + result_cache_key(fq)
+    facet_counts = facet_cache.get(key)
+    if facet_counts is None:
+        try:
+            results = search(q, fq + url_facet_fields, rows=0,
+                    facets=True)['results']
+        except SolrError as solr_error:
+            return Response(json.dumps({'error': solr_error.value}),
+                    status=502, mimetype='application/json')
+        facet_counts = results.get('facet_counts', {})
+        reverse_index_facets(facet_counts)
+        facet_cache.set(key, facet_counts)
+    collections = dict((c['identifier'], c)
+            for c in get_collections({'facet_counts': facet_counts,
+                'response': {'docs': []}}))
+    facet_args_dict = dict((f, request.args[f])
+            for f in facet_fields if request.args.get(f))
+    html = render_template('facet_sidebar.html', facets=facet_counts,
+        facet_fields=facet_fields, facet_args_dict=facet_args_dict,
+        collections=collections, changequery=changequery, comma=comma,
+        int=int, year_gap=year_gap, lang_map=lang_map,
+        fmt_licenseurl=fmt_licenseurl)
+    return Response(json.dumps({'facet_counts': facet_counts, 'html': html}),
+            mimetype='application/json')
+
+def test_split_facets():
+    global solr_select_url, cache_addr, split_facets
+    def handler(method, path, body):
+        params = path.split('?', 1)[1] if '?' in path else body
+        reply = {'response': {'numFound': 1, 'start': 0,
+            'docs': [{'identifier': 'item1', 'title': 'Item one'}]}}
+        if 'facet=true' in params:
+            reply['facet_counts'] = {'facet_fields': {'mediatype':
+                [['movies', 7]], 'year_from_date': [['1951', 1], ['1950', 2]]},
+                'facet_ranges': {'date': {'counts': []}}}
+        return (200, json.dumps(reply))
+    server = StubSolrServer(handler)
+    saved = (solr_select_url, cache_addr, split_facets)
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    cache_addr = server.addr
+    result_cache.clear()
+    facet_cache.clear()
+    try:
+        client = app.test_client()
+        page = client.get('/?q=test').data
+        assert 'Item one' in page and 'data-src="/facets?q=test"' in page
+        assert 'facet=true' not in server.requests[-1][1]
+        data = json.loads(client.get('/facets?q=test&page=2').data)
+        assert data['facet_counts']['facet_fields']['year_from_date'] == \
+                [['1950', 2], ['1951', 1]]
+        assert 'mediatype=movies' in data['html'] and '7' in data['html']
+        requests = len(server.requests)
+        client.get('/facets?q=test&page=3')
+        assert len(server.requests) == requests
+
+        split_facets = False
+        page = client.get('/?q=test').data
+        assert 'id="facets"' not in page and 'mediatype=movies' in page
+    finally:
+        (solr_select_url, cache_addr, split_facets) = saved
+        result_cache.clear()
+        facet_cache.clear()
+        server.close()
 
 @app.route("/")
 def search_page():
@@ -1135,77 +1942,188 @@ def search_page():
     facet_args_dict = dict(facet_args)
     page = int(request.args.get('page', 1))
     start = results_per_page * (page-1)
-    #fq = ''.join('&fq=' + quote('{!tag=%s}{!term f=%s}%s' % (f, f, request.args[f])) for f in facet_fields if f in request.args)
-    fq = ''.join('&fq=' + quote('{!tag=%s}%s:"%s"' % (f, f, esc(request.args[f]))) for f in facet_fields if request.args.get(f))
-    date_range = request.args.get('date_range')
     date_facet = request.args.get('date_facet')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-    if date_range:
-        m = re_date_range.match(date_range)
-        if m:
-            start_year, end_year = m.groups()
-            fq += '&fq=' + quote('date:[%s-01-01T00:00:00Z TO %s-01-01T00:00:00Z]' % (start_year, end_year))
-    elif date_facet:
-        fq += '&fq=' + quote('date:([%s-01-01T00:00:00Z TO %s-01-01T00:00:00Z+%dYEAR] NOT "%s-01-01T00:00:00Z+%dYEAR")' % (date_facet, date_facet, year_gap, date_facet, year_gap))
-    elif date_from and date_to:
-        fq += '&fq=' + quote('date:[%sT00:00:00Z TO %sT00:00:00Z]' % (date_from, date_to))
-
-    url_facet_fields = ''.join('&facet.field='+('{!ex=' + f + '}' if f in facet_args_dict else '') + f for f in facet_fields)
+    fq, url_facet_fields = search_filters(request.args)
 
-    url_params = '&start=%d' % start + fq + url_facet_fields
+    url_params = '&start=%d' % start + fq
+    if not split_facets:
+        url_params += url_facet_fields
+    nfpr = 'nfpr' in request.args
+
+    def get_did_you_mean(results):
+        if results.get('spellcheck', {}).get('suggestions'):
+            return parse_suggestions(q, results['spellcheck']['suggestions'])
+        return []
+
+    # A search that came back empty recently, with a collation that has
+    # hits, starts the corrected query alongside the main one. Either way
+    # there is at most one follow-up query.
+    spell_key = result_cache_key('q=' + quote(q) + fq)
+    predicted = None if nfpr else zero_hit_collations.get(spell_key)
+
+    def speculative_query():
+        try:
+            return search(predicted, url_params, facets=not split_facets)
+        except SolrError:
+            return None
+
+    def spellcheck_query(main, speculative=None):
+        results = main['results']
+        if results['response']['numFound']:
+            if predicted:
+                zero_hit_collations.discard(spell_key)
+            return None
+        if nfpr:
+            return None
+        collation = parse_collation(results.get('spellcheck', {})
+                .get('suggestions', []))
+        if collation:
+            new_q, hits = collation
+            if hits == 0:
+                return None
+            zero_hit_collations.set(spell_key, new_q)
+        else:
+            did_you_mean = get_did_you_mean(results)
+            if not did_you_mean:
+                return None
+            new_q = ''.join(i[1] for i in did_you_mean)
+        if speculative and new_q == predicted:
+            metrics.count('spellcheck_followups', mode='speculative')
+            return (new_q, speculative)
+        metrics.count('spellcheck_followups', mode='sequential')
+        return (new_q, search(new_q, url_params, facets=not split_facets))
+
+    # collection metadata and the spellcheck fallback both only need the
+    # main result, so they run side by side
+    plan = QueryPlan(budget=solr_page_budget)
+    plan.add('main', lambda: search(q, url_params, spellcheck=True,
+        facets=not split_facets))
+    plan.add('collections', lambda main: get_collections(main['results']),
+            ['main'])
+    if predicted:
+        plan.add('speculative', speculative_query)
+        plan.add('spellcheck', spellcheck_query, ['main', 'speculative'])
+    else:
+        plan.add('spellcheck', spellcheck_query, ['main'])
+    plan.run()
     try:
-        search_results = search(q, url_params, spellcheck=True, facets=True)
+        search_results = plan.result('main')
+        alt_search = plan.result('spellcheck')
     except SolrError as solr_error:
         return solr_error.value
+    except QueryTimeout:
+        return 'Solr did not answer within %d seconds' % solr_page_budget
     results = search_results['results']
-    t_solr = search_results['t_solr']
-
-    alt_results = False
-    did_you_mean = []
-    if results.get('spellcheck', {}).get('suggestions'):
-        did_you_mean = parse_suggestions(q, results['spellcheck']['suggestions'])
-    if results['response']['numFound'] == 0 and did_you_mean and 'nfpr' not in request.args:
-        new_q = ''.join(i[1] for i in did_you_mean)
-        try:
-            search_results = search(new_q, url_params, facets=True)
-        except SolrError as solr_error:
-            return solr_error.value
-        alt_results = True
+    t_solr = plan.elapsed
 
-    t0_solr = time()
-    collections = dict((c['identifier'], c) for c in get_collections(results))
-    add_hidden_tag(results['response']['docs'], collections)
-    t_solr += time() - t0_solr
+    did_you_mean = get_did_you_mean(results)
+    alt_results = alt_search is not None
+    if alt_results:
+        alt_q, alt_search_results = alt_search
+        if alt_q != ''.join(i[1] for i in did_you_mean):
+            did_you_mean = [('fix', alt_q)]
+
+    try:
+        collections = dict((c['identifier'], c)
+                for c in plan.result('collections'))
+    except QueryTimeout:
+        collections = {}
+    add_hidden_tag(results['response']['docs'],
+            restricted_collections(collections.itervalues()))
 
     pager = build_pager(results['response']['numFound'], page)
 
+    if alt_results:
+        search_results = alt_search_results
     url = search_results['url']
     results = search_results['results']
-    t_solr += search_results['t_solr']
 
-
-    for f in 'tv_original_year', 'year_from_date':
-        try:
-            results['facet_counts']['facet_fields'][f].reverse()
-        except KeyError:
-            pass
+    facets = results.get('facet_counts')
+    facets_url = None
+    if facets:
+        reverse_index_facets(facets)
+    else:
+        facets_args = [(k, v.encode('utf-8'))
+                for k, v in request.args.iteritems(True)
+                if k not in ('q', 'page', 'view', 'nfpr')]
+        facet_q = alt_q if alt_results else q
+        facets_url = url_for('facets_page') + '?' + urlencode(
+                [('q', facet_q.encode('utf-8'))] + facets_args)
+
+    doc_thumbs = {}
+    max_thumbs = 0
+    if view == 'search':
+        doc_thumbs = prefetch_thumbs(results['response']['docs'])
+    elif view == 'thumb_compare':
+        doc_thumbs = prefetch_thumbs(results['response']['docs'],
+                movies_only=True)
+        max_thumbs = add_thumbs_to_docs(results['response']['docs'],
+                doc_thumbs)
 
     return render_template(view + '.html', q=q, page=page, 
         results=results, results_per_page=results_per_page, pager=pager,
         quote=quote, comma=comma, int=int, facet_fields=facet_fields, 
         lang_map=lang_map, facet_args=facet_args,
-        get_movie_thumb=get_movie_thumb, year_gap=year_gap,
-        find_item=find_item, enumerate=enumerate, len=len,
+        doc_thumbs=doc_thumbs, year_gap=year_gap,
+        enumerate=enumerate, len=len,
         pick_best=pick_best, url=url, facet_args_dict=facet_args_dict,
-        get_img_thumb = get_img_thumb, changequery=changequery,
+        max_thumbs=max_thumbs, changequery=changequery,
         zap_field=zap_field, token_hl=token_hl, t_solr=t_solr,
-        collections=collections, did_you_mean=did_you_mean,
+        solr_timings=plan.timing_breakdown(), collections=collections,
+        did_you_mean=did_you_mean,
         alt_results=alt_results, fmt_licenseurl=fmt_licenseurl,
-        add_thumbs_to_docs=add_thumbs_to_docs,
         strip_long_repeating_phrase=strip_long_repeating_phrase,
-        list_fields=list_fields, field_set=field_set,
+        list_fields=list_fields, field_set=field_set, facets=facets,
+        facets_url=facets_url,
         date_facet=(int(date_facet) if date_facet is not None else None))
     
+def test_spellcheck_fallback():
+    global solr_select_url, cache_addr
+    from urlparse import parse_qs
+    def handler(method, path, body):
+        params = parse_qs(path.split('?', 1)[1] if '?' in path else body)
+        q = params['q'][0]
+        docs = [{'identifier': 'food1', 'title': 'Food one'}] \
+                if q == 'food' else []
+        reply = {'response': {'numFound': len(docs), 'start': 0,
+            'docs': docs}}
+        if 'spellcheck' in params:
+            reply['spellcheck'] = {'suggestions': [['foodd',
+                {'numFound': 1, 'startOffset': 0, 'endOffset': 5,
+                    'suggestion': ['food']}],
+                ['collation', [['collationQuery', 'food'],
+                    ['hits', 0 if q == 'xfoodd' else 1]]]]}
+        return (200, json.dumps(reply))
+    server = StubSolrServer(handler)
+    saved = (solr_select_url, cache_addr)
+    solr_select_url = 'http://' + server.addr + '/solr/select'
+    cache_addr = server.addr
+    result_cache.clear()
+    zero_hit_collations.clear()
+    def followups(mode):
+        return metrics.metrics.counters[('spellcheck_followups',
+            (('mode', mode),))]
+    try:
+        client = app.test_client()
+        sequential = followups('sequential')
+        page = client.get('/?q=foodd').data
+        assert 'Showing results for' in page and 'Food one' in page
+        assert len(server.requests) == 2
+        assert followups('sequential') == sequential + 1
+
+        result_cache.clear()
+        speculative = followups('speculative')
+        page = client.get('/?q=foodd').data
+        assert 'Food one' in page and len(server.requests) == 4
+        assert followups('speculative') == speculative + 1
+
+        page = client.get('/?q=xfoodd').data
+        assert 'Food one' not in page and len(server.requests) == 5
+    finally:
+        (solr_select_url, cache_addr) = saved
+        result_cache.clear()
+        zero_hit_collations.clear()
+        server.close()
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8081, debug=True)
@@ -0,0 +1,295 @@
+from httplib import HTTPConnection, HTTPException
+from urlparse import urlsplit
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock
+from collections import defaultdict
+import socket, json, re
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+class PooledResponse(object):
+    # File-like wrapper round an httplib response. The connection goes back
+    # to the pool once the body has been read to the end; closing early
+    # throws the connection away instead.
+
+    def __init__(self, client, host, conn, response):
+        self.client = client
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if self.conn and self.response.isclosed():
+            if self.response.will_close:
+                self.conn.close()
+            else:
+                self.client.release(self.host, self.conn)
+            self.conn = None
+        return data
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class SolrClient(object):
+    def __init__(self, timeout=30, retries=1, max_idle=10):
+        self.timeout = timeout
+        self.retries = retries
+        self.max_idle = max_idle
+        self.pools = defaultdict(list)
+        self.lock = Lock()
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+
+    def get_connection(self, host, fresh=False):
+        with self.lock:
+            self.requests += 1
+            idle = self.pools[host]
+            if idle and not fresh:
+                self.reused += 1
+                return (idle.pop(), True)
+            self.opened += 1
+        return (HTTPConnection(host, timeout=self.timeout), False)
+
+    def drain(self, host):
+        # A dead keep-alive connection usually means the server dropped all
+        # of them, so the rest of the pool is thrown away too.
+        with self.lock:
+            idle = self.pools.pop(host, [])
+        for conn in idle:
+            conn.close()
+
+    def release(self, host, conn):
+        with self.lock:
+            idle = self.pools[host]
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def open(self, url, data=None, idempotent=None):
+        (scheme, host, path, query, fragment) = urlsplit(url)
+        if query:
+            path += '?' + query
+        method = 'GET' if data is None else 'POST'
+        if idempotent is None:
+            idempotent = method == 'GET'
+        headers = {}
+        if data is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        attempt = 0
+        while True:
+            (conn, reused) = self.get_connection(host, fresh=attempt > 0)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except (HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    self.drain(host)
+                if not idempotent or attempt >= self.retries:
+                    raise
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                continue
+            return PooledResponse(self, host, conn, response)
+
+    def fetch(self, url, data=None, idempotent=None):
+        return self.open(url, data, idempotent).read()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'connections_opened': self.opened,
+            'connections_reused': self.reused,
+            'retried': self.retried,
+            'idle': sum(len(idle) for idle in self.pools.values()),
+        }
+
+re_response_start = re.compile(r'"response"\s*:\s*\{')
+re_docs_start = re.compile(r'"docs"\s*:\s*\[')
+re_num_found = re.compile(r'"numFound"\s*:\s*(\d+)')
+re_skip = re.compile(r'[\s,]*')
+
+class DocStream(object):
+    # Decodes response.docs from a Solr JSON reply one doc at a time, so the
+    # raw body and the full decoded tree are never in memory together.
+    # Everything around the docs array is available as .results (with an
+    # empty docs list) once the docs have been consumed.
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.results = None
+        self.buf = ''
+        self.pos = 0
+        while True:
+            m = re_response_start.search(self.buf)
+            m = m and re_docs_start.search(self.buf, m.end())
+            if m:
+                break
+            if not self.read_more():
+                raise ValueError(self.buf)
+        self.head = self.buf[:m.end()]
+        self.pos = m.end()
+        self.num_found = int(re_num_found.search(self.head).group(1))
+
+    def read_more(self):
+        data = self.f.read(self.chunk_size)
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += data
+        return bool(data)
+
+    def __iter__(self):
+        while True:
+            self.pos = re_skip.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf):
+                if not self.read_more():
+                    raise ValueError('truncated Solr response')
+                continue
+            if self.buf[self.pos] == ']':
+                break
+            try:
+                doc, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+            self.pos = end
+            yield doc
+        tail = [self.buf[self.pos:]]
+        self.buf = ''
+        while True:
+            data = self.f.read(self.chunk_size)
+            if not data:
+                break
+            tail.append(data)
+        self.results = json.loads(self.head + ''.join(tail))
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubSolrServer(object):
+    # Local HTTP/1.1 server for tests. handler(method, path, body) returns
+    # (status, body).
+
+    def __init__(self, handler):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, body):
+                stub.requests.append((self.command, self.path, body))
+                status, reply = handler(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def do_GET(self):
+                self.respond(None)
+
+            def do_POST(self):
+                length = int(self.headers.getheader('content-length', 0))
+                self.respond(self.rfile.read(length))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.addr = '%s:%d' % self.server.server_address
+        t = Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def test_solr_client_reuses_connections():
+    server = StubSolrServer(lambda method, path, body:
+            (200, '{"method": "%s", "body": "%s"}' % (method, body or '')))
+    client = SolrClient(timeout=5)
+    try:
+        url = 'http://' + server.addr + '/solr/select'
+        assert client.fetch(url + '?q=a') == '{"method": "GET", "body": ""}'
+        assert client.fetch(url, 'q=b') == '{"method": "POST", "body": "q=b"}'
+        f = client.open(url + '?q=c')
+        while f.read(4):
+            pass
+        stats = client.stats()
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 2
+        assert stats['idle'] == 1
+    finally:
+        server.close()
+
+def test_solr_client_retries_on_fresh_connection():
+    server = StubSolrServer(lambda method, path, body: (200, '{}'))
+    client = SolrClient(timeout=5)
+    try:
+        url = 'http://' + server.addr + '/solr/select?q=a'
+        responses = [client.open(url) for i in range(3)]
+        for f in responses:
+            assert f.read() == '{}'
+        assert client.stats()['idle'] == 3
+        for conn in client.pools[server.addr]:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        assert client.fetch(url) == '{}'
+        stats = client.stats()
+        assert stats['retried'] == 1
+        assert stats['connections_opened'] == 4
+        assert stats['idle'] == 1
+
+        conn = client.pools[server.addr][0]
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        assert client.fetch(url, 'q=b', idempotent=True) == '{}'
+        try:
+            conn = client.pools[server.addr][0]
+            conn.sock.shutdown(socket.SHUT_RDWR)
+            client.fetch(url, 'q=b')
+        except (HTTPException, socket.error):
+            pass
+        else:
+            assert False
+    finally:
+        server.close()
+
+def test_doc_stream():
+    from StringIO import StringIO
+    docs = [{'identifier': 'item%d' % i, 'title': u'caf\xe9 ]} %d' % i}
+            for i in range(500)]
+    reply = json.dumps({
+        'responseHeader': {'status': 0, 'params': {'q': 'docs'}},
+        'response': {'numFound': 1234, 'start': 0, 'docs': docs},
+        'stats': {'stats_fields': {'item_size': {'sum': 10}}},
+    }, indent=1, ensure_ascii=False).encode('utf-8')
+    stream = DocStream(StringIO(reply), chunk_size=100)
+    assert stream.num_found == 1234
+    assert list(stream) == docs
+    assert stream.results['response'] == \
+            {'numFound': 1234, 'start': 0, 'docs': []}
+    assert stream.results['stats']['stats_fields']['item_size']['sum'] == 10
+
+    empty = DocStream(StringIO('{"response":{"numFound":0,"docs":[]}}'))
+    assert list(empty) == []
+    try:
+        DocStream(StringIO('<html>error</html>'))
+    except ValueError as e:
+        assert e.args[0] == '<html>error</html>'
+    else:
+        assert False
@@ -0,0 +1,76 @@
+from urllib import quote_plus
+
+# Copyright(c)2012 Internet Archive. Software license GPL version 2.
+
+def encode_value(v):
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    return quote_plus(str(v))
+
+def encode(pairs):
+    # '&k=v' for each pair, ready to append to a query string
+    return ''.join('&' + quote_plus(k) + '=' + encode_value(v)
+            for k, v in pairs)
+
+class SolrParams(object):
+    # A Solr query string as a list of encoded segments. Segments that are
+    # the same for every request are encoded once at import and shared;
+    # per-request ones are appended and the whole list is joined once.
+    # The same object gives either a GET URL or a POST body, depending on
+    # its length.
+
+    def __init__(self, base, max_get=1024):
+        self.segments = [base]
+        self.max_get = max_get
+        self.encoded = None
+
+    def add(self, k, v):
+        return self.add_segment('&' + quote_plus(k) + '=' + encode_value(v))
+
+    def add_segment(self, segment):
+        if segment:
+            self.segments.append(segment)
+            self.encoded = None
+        return self
+
+    def __str__(self):
+        if self.encoded is None:
+            self.encoded = ''.join(self.segments)
+        return self.encoded
+
+    def use_get(self):
+        return len(str(self)) < self.max_get
+
+    def get_url(self, base_url):
+        return base_url + '?' + str(self)
+
+class FieldList(object):
+    # memoized '&fl=...' segments, one per distinct list of fields
+
+    def __init__(self):
+        self.segments = {}
+
+    def __call__(self, fields):
+        key = tuple(fields)
+        segment = self.segments.get(key)
+        if segment is None:
+            segment = encode([('fl', ','.join(fields))])
+            self.segments[key] = segment
+        return segment
+
+def test_solr_params():
+    params = SolrParams('wt=json' + encode([('q.op', 'AND')]), max_get=40)
+    params.add('q', u'caf\xe9 "x"').add('rows', 30).add_segment('')
+    assert str(params) == 'wt=json&q.op=AND&q=caf%C3%A9+%22x%22&rows=30'
+    assert not params.use_get()
+    params.max_get = 100
+    assert params.use_get()
+    assert params.get_url('http://solr/select') == \
+            'http://solr/select?' + str(params)
+
+def test_field_list():
+    fl = FieldList()
+    a = fl(['identifier', 'title'])
+    assert a == '&fl=identifier%2Ctitle'
+    assert fl(('identifier', 'title')) is a
+    assert len(fl.segments) == 1